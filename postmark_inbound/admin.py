@@ -1,10 +1,27 @@
 from django.contrib import admin
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
 
 from .models import InboundMail, InboundMailHeader, InboundMailAttachment, InboundMailDetail
 
 
+class LimitedInlineFormSet(BaseInlineFormSet):
+    """
+    Inline formset that only loads the first `max_rows` related objects, so
+    mails with hundreds of headers or attachments open quickly.
+    """
+    max_rows = 50
+
+    def get_queryset(self):
+        if not hasattr(self, '_limited_queryset'):
+            self._limited_queryset = super(LimitedInlineFormSet, self).get_queryset()[:self.max_rows]
+        return self._limited_queryset
+
+
 class InboundMailAttachmentInline(admin.StackedInline):
     model = InboundMailAttachment
+    formset = LimitedInlineFormSet
     extra = 0
     fields = ('name', 'content', 'content_type', 'content_length')
     readonly_fields = ('content_type', 'content_length')
@@ -12,6 +29,8 @@ class InboundMailAttachmentInline(admin.StackedInline):
 
 class InboundMailHeaderInline(admin.TabularInline):
     model = InboundMailHeader
+    formset = LimitedInlineFormSet
+    classes = ('collapse',)
     extra = 0
 
 
@@ -24,6 +43,7 @@ class InboundMailDetailsInline(admin.TabularInline):
 
 class InboundMailAdmin(admin.ModelAdmin):
     list_display = ('from_email', 'subject', 'date', 'has_attachment')
+    readonly_fields = ('attachment_count', 'total_attachment_bytes', 'all_headers')
     list_filter = ('date',)
     search_fields = ('from_email', 'subject', 'text_body')
     inlines = [InboundMailDetailsInline, InboundMailAttachmentInline, InboundMailHeaderInline]
@@ -32,8 +52,37 @@ class InboundMailAdmin(admin.ModelAdmin):
             'fields': ('from_name', 'from_email', 'to_email', 'subject', 'text_body')}),
         ('Metadata', {
             'classes': ('collapse',),
-            'fields': ('original_recipient', 'message_id', 'mailbox_hash', 'tag')})
+            'fields': ('original_recipient', 'message_id', 'mailbox_hash', 'tag',
+                       'attachment_count', 'total_attachment_bytes')}),
+        ('Headers', {
+            'classes': ('collapse',),
+            'fields': ('all_headers',)})
     )
 
+    def get_fieldsets(self, request, obj=None):
+        fieldsets = super(InboundMailAdmin, self).get_fieldsets(request, obj)
+        # Header rows are shown by the limited inline instead
+        if obj is None or not obj.compact_headers:
+            fieldsets = [fieldset for fieldset in fieldsets if fieldset[0] != 'Headers']
+        return fieldsets
+
+    def all_headers(self, obj):
+        return format_html_join(mark_safe('<br>'), '{}: {}',
+                                ((header.name, header.value) for header in obj.get_headers()))
+    all_headers.short_description = 'Headers'
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super(InboundMailAdmin, self).get_object(request, object_id, from_field)
+        # Load the deferred bodies with a single query
+        if obj is not None and obj.get_deferred_fields():
+            obj.refresh_from_db(fields=obj.get_deferred_fields())
+        return obj
+
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text search index instead of LIKE queries on `search_fields`
+        if not search_term:
+            return queryset, False
+        return queryset.search(search_term), False
+
 
 admin.site.register(InboundMail, InboundMailAdmin)
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class PostmarkWebhookConfig(AppConfig):
     name = 'postmark_inbound'
     verbose_name = 'Django Postmark Inbound Webhook'
+
+    def ready(self):
+        from .routing import route_inbound_mail
+        from .search import install_search_index
+        from .signals import inbound_mail_received
+        post_migrate.connect(install_search_index, sender=self)
+        inbound_mail_received.connect(route_inbound_mail, dispatch_uid='postmark_inbound.routing')
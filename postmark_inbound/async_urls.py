@@ -0,0 +1,12 @@
+from django.conf.urls import url
+
+from .async_views import inbound_mail_webhook
+from .views import InboundMailExportView, InboundMailListView, InboundMailRetrieveView
+
+
+urlpatterns = [
+    url(r'^inbound', inbound_mail_webhook),
+    url(r'^mail/$', InboundMailListView.as_view()),
+    url(r'^mail/export/$', InboundMailExportView.as_view()),
+    url(r'^mail/(?P<pk>\d+)/$', InboundMailRetrieveView.as_view()),
+]
@@ -0,0 +1,72 @@
+"""
+Async variant of `InboundMailWebhook` for ASGI deployments, requiring
+Django 3.1 or later. Route to it with `postmark_inbound.async_urls`.
+"""
+import asyncio
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseNotAllowed, JsonResponse
+
+from rest_framework import exceptions, status
+
+from .dispatch import send_robust_async
+from .instrumentation import RequestTimer, null_timer
+from .processing import aprocess_inbound_mail, get_executor
+from .settings import inbound_mail_options as option
+from .signals import inbound_mail_timed
+from .spool import get_spool
+from .views import InboundMailWebhook, PostmarkPermission
+
+if django.VERSION < (3, 1):
+    raise ImproperlyConfigured('The async inbound mail webhook requires Django 3.1 or later.')
+
+
+async def inbound_mail_webhook(request):
+    """
+    Receive inbound mail from Postmark without holding a thread for the
+    whole request. See `processing.aprocess_inbound_mail()`.
+
+    The ASGI handler receives the request body before calling the view.
+    Only reading it (it may have been spooled to a temporary file), parsing
+    and validation take a thread from the `ASYNC_WORKERS` pool, and database
+    and storage writes are run through `sync_to_async`. Signals are sent
+    with `InboundMailWebhook` as the sender, like the sync webhook.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not PostmarkPermission().has_permission(request, None):
+        return JsonResponse({'detail': exceptions.PermissionDenied.default_detail},
+                            status=status.HTTP_403_FORBIDDEN)
+
+    loop = asyncio.get_event_loop()
+    timer = RequestTimer() if option.INSTRUMENTATION else None
+    body = await loop.run_in_executor(get_executor(), lambda: request.body)
+    if timer is not None:
+        timer.payload_bytes = len(body)
+
+    mail_object = None
+    try:
+        if option.SPOOL_INBOUND_MAIL:
+            with (timer or null_timer).stage('spool'):
+                await loop.run_in_executor(get_executor(), get_spool().append, body)
+        else:
+            mail_object = await aprocess_inbound_mail(body, sender=InboundMailWebhook, timer=timer)
+    except exceptions.APIException as exc:
+        detail = exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail}
+        response = JsonResponse(detail, status=exc.status_code, safe=False)
+    else:
+        response = JsonResponse({'detail': 'Inbound mail received. Thanks Postmark!'},
+                                status=status.HTTP_202_ACCEPTED)
+
+    if timer is not None:
+        response['Server-Timing'] = timer.server_timing()
+        await send_robust_async(inbound_mail_timed, sender=InboundMailWebhook,
+                                timings=timer.as_dict(), mail_object=mail_object)
+        if option.LOG_TIMINGS:
+            timer.log()
+    return response
+
+
+# `csrf_exempt()` only supports async views from Django 5.0
+inbound_mail_webhook.csrf_exempt = True
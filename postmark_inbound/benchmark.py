@@ -0,0 +1,205 @@
+"""
+Benchmarks for the inbound mail pipeline, run with the
+`benchmark_inbound_mail` management command.
+
+Synthetic Postmark payloads are pushed through each stage of the webhook
+(parsing, validation, attachment decoding, persistence and signal dispatch)
+and the duration of each stage is recorded separately. Peak memory is
+measured in a separate pass, as tracing allocations slows every stage down.
+"""
+import json
+import os
+import random
+import time
+import tracemalloc
+import uuid
+from base64 import b64encode
+
+from django.db import transaction
+from django.dispatch import Signal
+from six import BytesIO
+
+from .models import InboundMailAttachment
+from .parsers import PostmarkJSONParser, underscoreize
+from .processing import get_serializer_class
+from .serializers import Base64FileField, InboundMailSerializer
+from .utils import get_extension_resolver
+
+STAGES = ('parse', 'underscoreize', 'validate', 'decode_attachments',
+          'resolve_extensions', 'create', 'signal')
+
+# Stands in for `inbound_mail_received`, so the project's receivers (with
+# their side effects) don't run while benchmarking
+benchmark_signal = Signal()
+
+
+def noop_receiver(sender, **kwargs):
+    pass
+
+benchmark_signal.connect(noop_receiver)
+
+
+def generate_address(rng, domain='example.com'):
+    name = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(8))
+    return {'Email': '%s@%s' % (name, domain), 'Name': name.title(), 'MailboxHash': ''}
+
+
+def generate_attachment(i, size):
+    # Every other attachment has a generic content type and no extension, so
+    # its extension is sniffed from the content with libmagic
+    if i % 2:
+        return {
+            'Name': 'attachment-%d' % i,
+            'Content': b64encode(b'%PDF-1.4\n' + os.urandom(max(size - 9, 0))).decode('ascii'),
+            'ContentType': 'application/octet-stream',
+            'ContentLength': max(size, 9),
+        }
+    return {
+        'Name': 'attachment-%d.bin' % i,
+        'Content': b64encode(os.urandom(size)).decode('ascii'),
+        'ContentType': 'application/octet-stream',
+        'ContentLength': size,
+    }
+
+
+def generate_payload(headers=50, recipients=10, attachments=2, attachment_size=100 * 1024, seed=0):
+    """
+    Generate a realistic Postmark inbound payload (as a dict with Postmark's
+    keys) with the given number of headers, To/Cc recipients and attachments
+    of `attachment_size` bytes.
+    """
+    rng = random.Random(seed)
+    sender = generate_address(rng)
+    to = [generate_address(rng) for i in range(recipients - recipients // 2)]
+    cc = [generate_address(rng) for i in range(recipients // 2)]
+    text_body = ' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet']) for i in range(500))
+
+    return {
+        'FromName': sender['Name'],
+        'From': sender['Email'],
+        'FromFull': sender,
+        'To': ', '.join(address['Email'] for address in to),
+        'ToFull': to,
+        'Cc': ', '.join(address['Email'] for address in cc),
+        'CcFull': cc,
+        'Bcc': '',
+        'BccFull': [],
+        'OriginalRecipient': to[0]['Email'] if to else '',
+        'Subject': 'Benchmark message',
+        'MessageID': str(uuid.UUID(int=rng.getrandbits(128))),
+        'ReplyTo': '',
+        'MailboxHash': '',
+        'Date': 'Fri, 1 Aug 2014 16:45:32 -04:00',
+        'TextBody': text_body,
+        'HtmlBody': '<html><body><p>%s</p></body></html>' % text_body,
+        'StrippedTextReply': '',
+        'Tag': '',
+        'Headers': [{'Name': 'X-Header-%d' % i, 'Value': 'value %d' % i} for i in range(headers)],
+        'Attachments': [generate_attachment(i, attachment_size) for i in range(attachments)],
+    }
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.timings = dict((stage, []) for stage in STAGES)
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings[stage].append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, timings in self.timings.items():
+            if not timings:
+                continue
+            timings = sorted(timings)
+            summary[stage] = {
+                'min': timings[0],
+                'median': timings[len(timings) // 2],
+                'mean': sum(timings) / len(timings),
+                'max': timings[-1],
+            }
+        return summary
+
+
+def run_pipeline(timer, payload):
+    """
+    Run `payload` through every stage of the webhook once. Database changes
+    are rolled back and stored attachment files deleted afterwards.
+    """
+    payload = dict(payload, MessageID=uuid.uuid4().hex)
+    raw = json.dumps(payload).encode('UTF8')
+
+    data = timer.time('parse', PostmarkJSONParser().parse, BytesIO(raw))
+    timer.time('underscoreize', underscoreize, json.loads(raw.decode('UTF8')))
+
+    field = Base64FileField(sniff_extension=False)
+    resolver = get_extension_resolver()
+    for attachment in payload['Attachments']:
+        content = timer.time('decode_attachments', field.to_internal_value, attachment['Content'])
+        head = content.read(resolver.sniff_bytes)
+        timer.time('resolve_extensions', resolver.resolve, head,
+                   content_type=attachment['ContentType'], name=attachment['Name'])
+
+    serializer = get_serializer_class()(data=data)
+    timer.time('validate', serializer.is_valid, raise_exception=True)
+
+    with transaction.atomic():
+        mail_object = timer.time('create', serializer.save)
+        timer.time('signal', benchmark_signal.send_robust, sender=InboundMailSerializer,
+                   mail_data=serializer.validated_data, mail_object=mail_object)
+        file_names = list(InboundMailAttachment.objects.filter(parent_mail=mail_object)
+                          .values_list('content', flat=True))
+        transaction.set_rollback(True)
+
+    storage = InboundMailAttachment._meta.get_field('content').storage
+    for name in file_names:
+        storage.delete(name)
+
+
+def run_benchmark(iterations=10, **payload_options):
+    """
+    Benchmark the pipeline and return the results as a JSON-serializable dict.
+    """
+    payload = generate_payload(**payload_options)
+    timer = StageTimer()
+
+    # Warm up caches (e.g. the libmagic handle) before measuring
+    run_pipeline(StageTimer(), payload)
+
+    for i in range(iterations):
+        run_pipeline(timer, payload)
+
+    # Tracing allocations slows stages down unevenly, so it isn't timed
+    tracemalloc.start()
+    try:
+        run_pipeline(StageTimer(), payload)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'payload': payload_options,
+        'iterations': iterations,
+        'stages': timer.summary(),
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Compare benchmark results with a baseline. Returns a list of
+    `(metric, baseline, current)` tuples for every stage median (and the
+    peak memory) that is more than `tolerance` worse than the baseline.
+    """
+    regressions = []
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous and current['median'] > previous['median'] * (1 + tolerance):
+            regressions.append((stage, previous['median'], current['median']))
+    previous_memory = baseline.get('peak_memory_bytes')
+    if previous_memory and results['peak_memory_bytes'] > previous_memory * (1 + tolerance):
+        regressions.append(('peak_memory_bytes', previous_memory, results['peak_memory_bytes']))
+    return regressions
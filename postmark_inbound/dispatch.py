@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.db import close_old_connections, transaction
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+from .settings import inbound_mail_options as option
+
+logger = logging.getLogger(__name__)
+
+
+def get_receiver_name(receiver):
+    return '%s.%s' % (getattr(receiver, '__module__', None),
+                      getattr(receiver, '__qualname__', repr(receiver)))
+
+
+class ReceiverStats(object):
+    """
+    Execution counters for a single signal receiver.
+    """
+    __slots__ = ('calls', 'failures', 'timeouts', 'dropped', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.calls = self.failures = self.timeouts = self.dropped = 0
+        self.total_time = self.max_time = 0.0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class ReceiverCall(object):
+    """
+    A receiver call in progress, watched for timeouts.
+    """
+    __slots__ = ('name', 'start', 'timed_out')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.timed_out = False
+
+
+class DeferredSignalDispatcher(object):
+    """
+    Send a signal after the current transaction has been committed, calling
+    each receiver on a bounded thread pool instead of the request thread.
+
+    Receivers are called with the same arguments as `Signal.send()`. The
+    duration and outcome of every call is recorded per receiver (see
+    `stats()`). Python threads cannot be interrupted, so a receiver running
+    longer than `timeout` seconds is logged and counted as timed out by a
+    watchdog thread, but is left to finish. At most `max_pending` calls are
+    queued or running; calls beyond that are logged and dropped.
+    """
+    def __init__(self, signal, max_workers, timeout=None, max_pending=None):
+        self.signal = signal
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stats = {}
+        self._pending = set()
+        self._running = set()
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    def send(self, sender, **named):
+        transaction.on_commit(lambda: self.dispatch(sender, **named))
+
+    def dispatch(self, sender, **named):
+        if not self.signal.receivers:
+            return
+        self.start_watchdog()
+        for receiver in self.signal._live_receivers(sender):
+            with self._lock:
+                full = self.max_pending is not None and len(self._pending) >= self.max_pending
+                if full:
+                    self._get_stats(get_receiver_name(receiver)).dropped += 1
+            if full:
+                logger.error('Signal receiver queue is full (%d calls pending), dropping call to %s',
+                             self.max_pending, get_receiver_name(receiver))
+                continue
+            future = self.executor.submit(self.call_receiver, receiver, sender, named)
+            with self._lock:
+                self._pending.add(future)
+            future.add_done_callback(self._discard)
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def _get_stats(self, name):
+        # Called with the lock held
+        return self._stats.setdefault(name, ReceiverStats())
+
+    def start_watchdog(self):
+        if self.timeout is None:
+            return
+        with self._lock:
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch, name='postmark-inbound-watchdog')
+                self._watchdog.daemon = True
+                self._watchdog.start()
+
+    def _watch(self):
+        interval = min(max(self.timeout / 2.0, 0.01), 1.0)
+        while True:
+            time.sleep(interval)
+            self.check_timeouts()
+
+    def check_timeouts(self):
+        """
+        Log and count receivers that have been running longer than `timeout`.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            overdue = [call for call in self._running
+                       if not call.timed_out and now - call.start > self.timeout]
+            for call in overdue:
+                call.timed_out = True
+                self._get_stats(call.name).timeouts += 1
+        for call in overdue:
+            logger.warning('Signal receiver %s has been running for more than %.3fs',
+                           call.name, self.timeout)
+
+    def call_receiver(self, receiver, sender, named):
+        call = ReceiverCall(get_receiver_name(receiver))
+        with self._lock:
+            self._running.add(call)
+        failed = False
+        try:
+            receiver(signal=self.signal, sender=sender, **named)
+        except Exception:
+            failed = True
+            logger.exception('Signal receiver %s raised an exception', call.name)
+        finally:
+            close_old_connections()
+            with self._lock:
+                self._running.discard(call)
+
+        elapsed = time.perf_counter() - call.start
+        # Calls finishing between two checks of the watchdog
+        timed_out = not call.timed_out and self.timeout is not None and elapsed > self.timeout
+        if timed_out:
+            logger.warning('Signal receiver %s took %.3fs (timeout %.3fs)',
+                           call.name, elapsed, self.timeout)
+
+        with self._lock:
+            stats = self._get_stats(call.name)
+            stats.calls += 1
+            stats.failures += failed
+            stats.timeouts += timed_out
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+
+    def stats(self):
+        """
+        Return a snapshot of the execution counters for each receiver.
+        """
+        with self._lock:
+            return dict((name, stats.as_dict()) for name, stats in self._stats.items())
+
+    def join(self, timeout=None):
+        """
+        Wait for receivers that have been dispatched to finish.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+
+def get_dispatcher(signal):
+    """
+    Return the process-wide deferred dispatcher for `signal`.
+    """
+    with _dispatchers_lock:
+        if signal not in _dispatchers:
+            _dispatchers[signal] = DeferredSignalDispatcher(
+                signal, option.SIGNAL_WORKERS, option.SIGNAL_RECEIVER_TIMEOUT, option.SIGNAL_QUEUE_SIZE)
+        return _dispatchers[signal]
+
+
+async def send_robust_async(signal, sender, **named):
+    """
+    Send `signal` like `Signal.send_robust()` from async code. Receivers that
+    are coroutine functions are awaited, others are called through
+    `sync_to_async`.
+    """
+    if hasattr(signal, 'asend_robust'):  # Django >= 5.0
+        return await signal.asend_robust(sender=sender, **named)
+
+    responses = []
+    for receiver in signal._live_receivers(sender):
+        try:
+            if asyncio.iscoroutinefunction(receiver):
+                response = await receiver(signal=signal, sender=sender, **named)
+            else:
+                response = await sync_to_async(receiver)(signal=signal, sender=sender, **named)
+        except Exception as err:
+            response = err
+        responses.append((receiver, response))
+    return responses
@@ -0,0 +1,95 @@
+"""
+Export stored inbound mail as JSON lines in the shape of Postmark's webhook
+payload, so it can be imported again with `import_inbound_mail`.
+"""
+import json
+import logging
+from email.utils import format_datetime
+
+from .models import InboundMailDetail
+from .parsers import postmark_key
+from .settings import inbound_mail_options as option
+from .utils import b64encode_file
+
+logger = logging.getLogger(__name__)
+
+MAIL_FIELDS = ('from_name', 'from_email', 'to_email', 'cc_email', 'bcc_email', 'original_recipient',
+               'subject', 'message_id', 'reply_to', 'mailbox_hash', 'text_body', 'html_body',
+               'stripped_text_reply', 'tag')
+DETAIL_FIELDS = ('email', 'name', 'mailbox_hash')
+ATTACHMENT_FIELDS = ('name', 'content_type', 'content_length', 'content_id')
+
+
+def iter_mail(queryset, batch_size=None):
+    """
+    Iterate over `queryset` in batches by primary key, prefetching the
+    related rows of one batch at a time.
+    """
+    batch_size = batch_size or option.EXPORT_BATCH_SIZE
+    queryset = queryset.with_bodies().with_details().order_by('pk')
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        for inbound_mail in batch:
+            yield inbound_mail
+        if len(batch) < batch_size:
+            break
+        last_pk = batch[-1].pk
+
+
+def get_detail_data(detail):
+    return dict((postmark_key(field), getattr(detail, field)) for field in DETAIL_FIELDS)
+
+
+def get_mail_data(inbound_mail):
+    """
+    Return the Postmark payload of `inbound_mail`, except for attachments.
+    """
+    data = dict((postmark_key(field), getattr(inbound_mail, field)) for field in MAIL_FIELDS)
+    data['Date'] = format_datetime(inbound_mail.date)
+    try:
+        data['FromFull'] = get_detail_data(inbound_mail.from_full)
+    except InboundMailDetail.DoesNotExist:
+        data['FromFull'] = {}
+    for field in ('to_full', 'cc_full', 'bcc_full'):
+        data[postmark_key(field)] = [get_detail_data(detail) for detail in getattr(inbound_mail, field)]
+    data['Headers'] = [{'Name': header.name, 'Value': header.value} for header in inbound_mail.get_headers()]
+    return data
+
+
+def encode_attachment(attachment):
+    """
+    Yield the JSON object of an attachment in pieces, base64 encoding the
+    file a chunk at a time.
+    """
+    data = dict((postmark_key(field), getattr(attachment, field)) for field in ATTACHMENT_FIELDS)
+    # Base64 never needs escaping, so the content is written straight into the string
+    yield json.dumps(data)[:-1] + ', "Content": "'
+    try:
+        attachment.content.open('rb')
+    except (IOError, OSError):
+        logger.warning('Attachment %s of inbound mail %s is missing from storage',
+                       attachment.pk, attachment.parent_mail_id)
+    else:
+        try:
+            for chunk in b64encode_file(attachment.content):
+                yield chunk
+        finally:
+            attachment.content.close()
+    yield '"}'
+
+
+def export_mail(queryset, batch_size=None):
+    """
+    Yield the mail in `queryset` as JSON lines, in pieces small enough that
+    memory use doesn't depend on the size of the export or its attachments.
+    """
+    for inbound_mail in iter_mail(queryset, batch_size):
+        yield json.dumps(get_mail_data(inbound_mail))[:-1] + ', "Attachments": ['
+        for i, attachment in enumerate(inbound_mail.attachments.all()):
+            if i:
+                yield ', '
+            for piece in encode_attachment(attachment):
+                yield piece
+        yield ']}\n'
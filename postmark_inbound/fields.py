@@ -0,0 +1,110 @@
+import zlib
+from base64 import b64decode, b64encode
+
+from django.db import models
+from six import text_type
+
+from .settings import inbound_mail_options as option
+
+# Marks values stored compressed. Values without it are stored as plain text,
+# so existing rows remain readable. Plain values starting with it are always
+# compressed, so they can't be mistaken for compressed ones.
+COMPRESSED_PREFIX = '\x01zlib:'
+
+
+class CompressedText(text_type):
+    """
+    A value loaded from a `CompressedTextField` that has not been
+    decompressed yet.
+    """
+
+
+def compress(value):
+    return COMPRESSED_PREFIX + b64encode(zlib.compress(value.encode('UTF8'))).decode('ascii')
+
+
+def decompress(value):
+    try:
+        return zlib.decompress(b64decode(value[len(COMPRESSED_PREFIX):])).decode('UTF8')
+    except (TypeError, ValueError, zlib.error):
+        # A plain value starting with the prefix, saved before those were compressed
+        return text_type(value)
+
+
+class CompressedTextDescriptor(object):
+    """
+    Decompress the value of a `CompressedTextField` the first time it is
+    accessed on a model instance.
+    """
+    def __init__(self, field, deferred_attribute):
+        self.field = field
+        self.deferred_attribute = deferred_attribute
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        data = instance.__dict__
+        if self.field.attname not in data:
+            # Load the deferred value
+            return self.deferred_attribute.__get__(instance, cls)
+        value = data[self.field.attname]
+        if isinstance(value, CompressedText):
+            value = data[self.field.attname] = decompress(value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    """
+    A `TextField` that stores values of at least `threshold` characters
+    compressed with zlib (and base64 encoded), so it can use the same column
+    type as a `TextField`.
+
+    Values are decompressed when they're first accessed on a model instance.
+    Note that `values()` and `values_list()` return the stored `CompressedText`
+    for compressed values; use `fields.decompress()` to read them. Lookups
+    such as `icontains` don't match the contents of compressed values.
+    """
+    def __init__(self, *args, **kwargs):
+        self.threshold = kwargs.pop('threshold', None)
+        super(CompressedTextField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(CompressedTextField, self).deconstruct()
+        if self.threshold is not None:
+            kwargs['threshold'] = self.threshold
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(CompressedTextField, self).contribute_to_class(cls, name, *args, **kwargs)
+        setattr(cls, self.attname, CompressedTextDescriptor(self, cls.__dict__[self.attname]))
+
+    def get_threshold(self):
+        if self.threshold is not None:
+            return self.threshold
+        return option.BODY_COMPRESSION_THRESHOLD
+
+    def from_db_value(self, value, expression, connection, *args):
+        if value is not None and value.startswith(COMPRESSED_PREFIX):
+            return CompressedText(value)
+        return value
+
+    def to_python(self, value):
+        if isinstance(value, CompressedText):
+            return decompress(value)
+        return super(CompressedTextField, self).to_python(value)
+
+    def get_prep_value(self, value):
+        if isinstance(value, CompressedText):
+            # Loaded compressed and never accessed, store it as it is
+            return text_type(value)
+        value = super(CompressedTextField, self).get_prep_value(value)
+        if value is not None and value.startswith(COMPRESSED_PREFIX):
+            return compress(value)
+        threshold = self.get_threshold()
+        if value is None or threshold is None or len(value) < threshold:
+            return value
+        compressed = compress(value)
+        return compressed if len(compressed) < len(value) else value
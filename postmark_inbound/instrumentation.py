@@ -0,0 +1,89 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimer(object):
+    """
+    Collect the duration of each stage of handling an inbound mail request,
+    along with payload size, attachment totals and the number of queries.
+
+    Stages may be entered more than once (durations are added up) and may be
+    nested, e.g. `decode` is part of `validate`.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.queries = 0
+        self.payload_bytes = 0
+        self.attachment_count = 0
+        self.attachment_bytes = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def _count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def count_queries(self, connection):
+        """
+        Return a context manager counting the queries run on `connection`.
+        """
+        return connection.execute_wrapper(self._count_query)
+
+    def record_attachments(self, attachments):
+        self.attachment_count = len(attachments)
+        self.attachment_bytes = sum(attachment['content'].size for attachment in attachments)
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def as_dict(self):
+        return {
+            'stages': dict((name, round(duration * 1000, 3)) for name, duration in self.stages.items()),
+            'total': round(self.total * 1000, 3),
+            'queries': self.queries,
+            'payload_bytes': self.payload_bytes,
+            'attachment_count': self.attachment_count,
+            'attachment_bytes': self.attachment_bytes,
+        }
+
+    def server_timing(self):
+        """
+        Format the stage durations for a `Server-Timing` header.
+        """
+        metrics = ['%s;dur=%.3f' % (name, duration * 1000) for name, duration in self.stages.items()]
+        metrics.append('total;dur=%.3f' % (self.total * 1000))
+        metrics.append('queries;desc="%d"' % self.queries)
+        return ', '.join(metrics)
+
+    def log(self):
+        timings = self.as_dict()
+        logger.info('Inbound mail timings: %s', json.dumps(timings, sort_keys=True),
+                    extra={'timings': timings})
+
+
+class NullTimer(object):
+    """
+    Stand-in for `RequestTimer` when instrumentation is disabled.
+    """
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def record_attachments(self, attachments):
+        pass
+
+
+null_timer = NullTimer()
@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...benchmark import compare_results, run_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmark each stage of the inbound mail pipeline with synthetic '
+            'Postmark payloads. Nothing is kept in the database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--headers', type=int, default=50)
+        parser.add_argument('--recipients', type=int, default=10)
+        parser.add_argument('--attachments', type=int, default=2)
+        parser.add_argument('--attachment-size', type=int, default=100 * 1024,
+                            help='Size of each attachment in bytes.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--baseline', help='Compare the results with this JSON file.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed slowdown relative to the baseline (0.2 = 20%%).')
+
+    def handle(self, *args, **options):
+        results = run_benchmark(
+            iterations=options['iterations'],
+            headers=options['headers'],
+            recipients=options['recipients'],
+            attachments=options['attachments'],
+            attachment_size=options['attachment_size'])
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            regressions = compare_results(results, baseline, options['tolerance'])
+            for metric, previous, current in regressions:
+                self.stderr.write('%s regressed: %.6g -> %.6g' % (metric, previous, current))
+            if regressions:
+                raise CommandError('%d regression(s) compared to the baseline.' % len(regressions))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...fields import CompressedText, CompressedTextField
+from ...models import InboundMail
+
+
+class Command(BaseCommand):
+    help = 'Compress mail bodies stored before compression was enabled.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of mails processed per transaction.')
+
+    def handle(self, *args, **options):
+        fields = [field for field in InboundMail._meta.fields
+                  if isinstance(field, CompressedTextField)]
+        names = [field.attname for field in fields]
+        queryset = InboundMail.objects.values_list('pk', *names).order_by('pk')
+
+        last_pk = 0
+        updated = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not rows:
+                break
+            with transaction.atomic():
+                for row in rows:
+                    changes = {}
+                    for field, value in zip(fields, row[1:]):
+                        # Values still stored as plain text that are over the threshold
+                        if (value and not isinstance(value, CompressedText) and
+                                field.get_threshold() is not None and
+                                len(value) >= field.get_threshold()):
+                            changes[field.attname] = value
+                    if changes:
+                        # `update()` compresses the values through the field
+                        InboundMail.objects.filter(pk=row[0]).update(**changes)
+                        updated += 1
+            last_pk = rows[-1][0]
+
+        self.stdout.write('Compressed bodies of %d mail(s).' % updated)
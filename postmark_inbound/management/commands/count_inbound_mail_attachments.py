@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from ...models import InboundMail
+
+
+class Command(BaseCommand):
+    help = 'Fill in the attachment count and size of mail saved before they were stored.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of mails processed per transaction.')
+
+    def handle(self, *args, **options):
+        queryset = (InboundMail.objects.order_by('pk')
+                    .annotate(count=Count('attachments'), size=Sum('attachments__content_length'))
+                    .values_list('pk', 'attachment_count', 'total_attachment_bytes', 'count', 'size'))
+
+        last_pk = 0
+        updated = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not rows:
+                break
+            with transaction.atomic():
+                for pk, attachment_count, total_attachment_bytes, count, size in rows:
+                    # Rows migrated with a default of 0 are corrected too
+                    if (attachment_count, total_attachment_bytes) != (count, size or 0):
+                        InboundMail.objects.filter(pk=pk).update(attachment_count=count,
+                                                                 total_attachment_bytes=size or 0)
+                        updated += 1
+            last_pk = rows[-1][0]
+
+        self.stdout.write('Updated attachment counts of %d mail(s).' % updated)
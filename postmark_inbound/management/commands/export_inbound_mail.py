@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from ...export import export_mail
+from ...models import InboundMail
+from ...settings import inbound_mail_options as option
+
+
+class Command(BaseCommand):
+    help = ('Export inbound mail as JSON lines in the shape of Postmark\'s '
+            'payload, including attachments. The output can be read by '
+            'import_inbound_mail.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', '-o',
+            help='File to write to (defaults to standard output).')
+        parser.add_argument('--mailbox-hash', help='Only export mail with this mailbox hash.')
+        parser.add_argument('--tag', help='Only export mail with this tag.')
+        parser.add_argument(
+            '--batch-size', type=int, default=option.EXPORT_BATCH_SIZE,
+            help='Number of mails loaded per query.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to export from.')
+
+    def handle(self, *args, **options):
+        queryset = InboundMail.objects.using(options['database'])
+        if options['mailbox_hash'] is not None:
+            queryset = queryset.filter(mailbox_hash=options['mailbox_hash'])
+        if options['tag'] is not None:
+            queryset = queryset.filter(tag=options['tag'])
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                for piece in export_mail(queryset, options['batch_size']):
+                    output.write(piece)
+        else:
+            for piece in export_mail(queryset, options['batch_size']):
+                self.stdout.write(piece, ending='')
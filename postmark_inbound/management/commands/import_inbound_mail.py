@@ -0,0 +1,179 @@
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from six import BytesIO
+
+from rest_framework.exceptions import ParseError, ValidationError
+
+from ...parsers import PostmarkJSONParser
+from ...processing import process_inbound_mail
+from ...views import InboundMailWebhook
+
+
+def iter_payloads(paths):
+    """
+    Yield `(label, payload)` tuples for each raw Postmark payload found in
+    `paths`. Directories are searched recursively (in sorted order) for
+    `.json` files containing a single payload and `.jsonl` files containing
+    one payload per line.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(('.json', '.jsonl')):
+                        for item in iter_file_payloads(os.path.join(root, name)):
+                            yield item
+        else:
+            for item in iter_file_payloads(path):
+                yield item
+
+
+def iter_file_payloads(path):
+    if path.endswith('.jsonl'):
+        with open(path, 'rb') as f:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    yield '%s:%d' % (path, line_number), line
+    else:
+        with open(path, 'rb') as f:
+            yield path, f.read()
+
+
+def iter_chunks(payloads, chunk_size):
+    """
+    Group payloads into lists of `chunk_size`, keyed by the label of their
+    first payload so the same input always produces the same chunk keys.
+    """
+    chunk = []
+    for item in payloads:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk[0][0], chunk
+            chunk = []
+    if chunk:
+        yield chunk[0][0], chunk
+
+
+def init_worker():
+    # Worker processes started with "spawn" need Django to be set up again
+    if not apps.ready:
+        django.setup()
+
+
+def import_chunk(key, chunk, send_signals):
+    """
+    Import a chunk of payloads in a single transaction, using a savepoint for
+    each mail so one invalid payload doesn't discard the rest of the chunk.
+    Returns `(key, imported, errors)`.
+    """
+    imported = 0
+    errors = []
+    with transaction.atomic():
+        for label, payload in chunk:
+            try:
+                with transaction.atomic():
+                    data = PostmarkJSONParser().parse(BytesIO(payload))
+                    process_inbound_mail(data, sender=InboundMailWebhook, send_signal=send_signals)
+            except (ParseError, ValidationError) as exc:
+                errors.append((label, str(exc.detail)))
+            else:
+                imported += 1
+    return key, imported, errors
+
+
+class Command(BaseCommand):
+    help = 'Import archived Postmark inbound mail payloads from JSON or JSONL files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='+',
+            help='.json/.jsonl files or directories containing them.')
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes. Use 0 to import in this process.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of payloads imported per transaction.')
+        parser.add_argument(
+            '--checkpoint',
+            help='File recording imported chunks. Chunks listed in it are '
+                 'skipped, so an interrupted import can be resumed.')
+        parser.add_argument(
+            '--send-signals', action='store_true',
+            help='Send the inbound_mail_received signal for each imported mail.')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            if not os.path.exists(path):
+                raise CommandError('%s does not exist.' % path)
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+
+        completed = set()
+        checkpoint = None
+        if options['checkpoint']:
+            if os.path.exists(options['checkpoint']):
+                with open(options['checkpoint']) as f:
+                    completed = set(line.rstrip('\n') for line in f)
+            checkpoint = open(options['checkpoint'], 'a')
+
+        self.imported = self.failed = 0
+        self.started = time.time()
+        self.checkpoint = checkpoint
+        chunks = ((key, chunk) for key, chunk in iter_chunks(
+            iter_payloads(options['paths']), options['chunk_size'])
+            if key not in completed)
+
+        try:
+            if options['processes'] > 0:
+                self.import_parallel(chunks, options['processes'], options['send_signals'])
+            else:
+                for key, chunk in chunks:
+                    self.chunk_done(import_chunk(key, chunk, options['send_signals']))
+        finally:
+            if checkpoint:
+                checkpoint.close()
+
+        self.stdout.write('Imported %d mail(s), %d failed in %.1fs.' % (
+            self.imported, self.failed, time.time() - self.started))
+
+    def import_parallel(self, chunks, processes, send_signals):
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        pool = Pool(processes, initializer=init_worker)
+        try:
+            # Bound the number of chunks in flight so payloads are streamed
+            # from disk rather than queued up front
+            pending = deque()
+            for key, chunk in chunks:
+                pending.append(pool.apply_async(import_chunk, (key, chunk, send_signals)))
+                if len(pending) >= processes * 2:
+                    self.chunk_done(pending.popleft().get())
+            while pending:
+                self.chunk_done(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def chunk_done(self, result):
+        key, imported, errors = result
+        self.imported += imported
+        self.failed += len(errors)
+        for label, error in errors:
+            self.stderr.write('%s: %s' % (label, error))
+
+        if self.checkpoint:
+            self.checkpoint.write(key + '\n')
+            self.checkpoint.flush()
+
+        elapsed = time.time() - self.started
+        self.stdout.write('Imported %d mail(s), %d failed (%.1f mails/s)' % (
+            self.imported, self.failed, (self.imported + self.failed) / max(elapsed, 1e-6)))
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...partitioning import (PartitioningError, convert_to_partitioned, create_partitions, drop_partition,
+                             partitions_before)
+from ...settings import inbound_mail_options as option
+
+
+def month(value):
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+class Command(BaseCommand):
+    help = ('Partition inbound mail by month (PostgreSQL 11+). Creates the '
+            'partitions for the coming months, and optionally converts the '
+            'mail table or removes old partitions. Run it at least monthly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert', action='store_true',
+            help='Convert the existing mail table to a partitioned table first.')
+        parser.add_argument(
+            '--months-ahead', type=int, default=option.PARTITION_MONTHS_AHEAD,
+            help='Number of months after the current one to create partitions for.')
+        parser.add_argument(
+            '--drop-before', type=month, metavar='YYYY-MM',
+            help='Drop the partitions of months before this one, with their related rows '
+                 'and attachment files. Partitions detached earlier are dropped too.')
+        parser.add_argument(
+            '--detach-only', action='store_true',
+            help='With --drop-before, only detach the partitions, keeping them as tables.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to partition.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        try:
+            if options['convert']:
+                first_month = convert_to_partitioned(using)
+                self.stdout.write('Converted mail table, existing mail is kept for dates before %s.'
+                                  % first_month.strftime('%Y-%m'))
+
+            for name in create_partitions(options['months_ahead'], using):
+                self.stdout.write('Created partition %s.' % name)
+
+            if options['drop_before']:
+                names = partitions_before(options['drop_before'], using,
+                                          include_detached=not options['detach_only'])
+                for name in names:
+                    drop_partition(name, using, detach_only=options['detach_only'])
+                    self.stdout.write('%s partition %s.' % (
+                        'Detached' if options['detach_only'] else 'Dropped', name))
+        except PartitioningError as exc:
+            raise CommandError(str(exc))
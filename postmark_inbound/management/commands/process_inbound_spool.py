@@ -0,0 +1,116 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from six import BytesIO
+
+from rest_framework.exceptions import ParseError, ValidationError
+
+from ...parsers import PostmarkJSONParser
+from ...processing import process_inbound_mail
+from ...settings import inbound_mail_options as option
+from ...spool import get_spool
+from ...views import InboundMailWebhook
+
+logger = logging.getLogger(__name__)
+
+# Longest wait before retrying a failed payload when looping, in seconds
+MAX_RETRY_DELAY = 300
+
+
+class Command(BaseCommand):
+    help = 'Process inbound mail payloads written to the spool by the Postmark webhook.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=option.SPOOL_BATCH_SIZE,
+            help='Number of payloads claimed from the spool at a time.')
+        parser.add_argument(
+            '--workers', type=int, default=option.SPOOL_WORKERS,
+            help='Number of threads processing payloads concurrently.')
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep polling the spool for new payloads.')
+        parser.add_argument(
+            '--interval', type=float, default=1.0,
+            help='Seconds to wait between polls when the spool is empty.')
+        parser.add_argument(
+            '--max-attempts', type=int, default=option.SPOOL_MAX_ATTEMPTS,
+            help='Number of times a payload is tried before it is moved to failed.')
+        parser.add_argument(
+            '--recover', action='store_true',
+            help='Release payloads left in processing by a previous run first.')
+
+    def handle(self, *args, **options):
+        spool = get_spool()
+        workers = max(1, options['workers'])
+
+        if options['recover']:
+            released = spool.recover()
+            self.stdout.write('Released %d payload(s) for processing.' % released)
+
+        self.max_attempts = options['max_attempts']
+        processed = failed = 0
+        # Payloads released by this run, and when they may be retried. Without
+        # --loop they aren't retried until the next run.
+        retry_at = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                if options['loop']:
+                    now = time.time()
+                    retry_at = dict((name, at) for name, at in retry_at.items() if at > now)
+                names = spool.claim(options['batch_size'], exclude=retry_at)
+                if names:
+                    # Split the batch between workers so each thread reuses
+                    # its database connection for a slice of the batch
+                    slices = [names[i::workers] for i in range(workers)]
+                    for result in executor.map(self.process_slice, [spool] * workers, slices):
+                        processed += result[0]
+                        failed += result[1]
+                        for name in result[2]:
+                            delay = options['interval'] * 2 ** spool.attempts(name)
+                            retry_at[name] = time.time() + min(delay, MAX_RETRY_DELAY)
+                elif options['loop']:
+                    time.sleep(options['interval'])
+                else:
+                    break
+
+        self.stdout.write('Processed %d payload(s), %d failed.' % (processed, failed))
+
+    def process_slice(self, spool, names):
+        processed = failed = 0
+        released = []
+        try:
+            for name in names:
+                success, released_name = self.process_payload(spool, name)
+                if success:
+                    processed += 1
+                else:
+                    failed += 1
+                if released_name:
+                    released.append(released_name)
+        finally:
+            connection.close()
+        return processed, failed, released
+
+    def process_payload(self, spool, name):
+        """
+        Process a claimed payload. Returns whether it was processed and, if it
+        was returned to the spool to be retried, its new name.
+        """
+        try:
+            data = PostmarkJSONParser().parse(BytesIO(spool.read(name)))
+            process_inbound_mail(data, sender=InboundMailWebhook)
+        except (ParseError, ValidationError):
+            logger.exception('Invalid inbound mail payload %s', name)
+            spool.fail(name)
+            return False, None
+        except Exception:
+            # Leave the payload in the spool to be retried, unless it has
+            # failed too many times
+            logger.exception('Error processing inbound mail payload %s', name)
+            return False, spool.release(name, self.max_attempts)
+        spool.complete(name)
+        return True, None
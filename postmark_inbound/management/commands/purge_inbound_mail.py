@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import InboundMail
+from ...retention import delete_mail, expired_mail_filter
+from ...settings import inbound_mail_options as option
+
+
+class Command(BaseCommand):
+    help = ('Delete inbound mail older than the retention period, together with '
+            'headers, address details, attachments and attachment files.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=option.RETENTION_DAYS,
+            help='Delete mail older than this many days.')
+        parser.add_argument(
+            '--max-count', type=int, default=option.RETENTION_MAX_COUNT,
+            help='Delete all but this many of the most recent mails.')
+        parser.add_argument(
+            '--batch-size', type=int, default=option.PURGE_BATCH_SIZE,
+            help='Number of mails deleted per transaction.')
+        parser.add_argument(
+            '--sleep', type=float, default=option.PURGE_BATCH_DELAY,
+            help='Seconds to wait between batches.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to purge.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the mail that would be deleted.')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        expired = expired_mail_filter(options['days'], options['max_count'], using=using)
+        if expired is None:
+            raise CommandError('Set a retention limit with --days or --max-count '
+                               '(or the RETENTION_DAYS/RETENTION_MAX_COUNT options).')
+
+        queryset = InboundMail.objects.using(using).filter(expired)
+        if options['dry_run']:
+            self.stdout.write('%d mail(s) would be deleted.' % queryset.count())
+            return
+
+        ids = queryset.order_by('pk').values_list('pk', flat=True)
+        last_pk = 0
+        deleted = 0
+        while True:
+            batch = list(ids.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            delete_mail(batch, using)
+            deleted += len(batch)
+            last_pk = batch[-1]
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        self.stdout.write('Deleted %d mail(s).' % deleted)
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import InboundMail
+from ...search import SEARCH_FIELDS, get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Create the full-text search index and add every stored mail to it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of mails indexed per transaction.')
+        parser.add_argument(
+            '--database', default='default',
+            help='Database alias to index.')
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options['database'])
+        backend.install()
+
+        # Bodies are deferred by the default manager, and `only()` doesn't undo that
+        queryset = (InboundMail.objects.using(options['database']).with_bodies()
+                    .only('pk', *SEARCH_FIELDS).order_by('pk'))
+        last_pk = 0
+        count = 0
+        while True:
+            mails = list(queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not mails:
+                break
+            with transaction.atomic(using=options['database']):
+                backend.index(mails)
+            last_pk = mails[-1].pk
+            count += len(mails)
+
+        self.stdout.write('Indexed %d mail(s).' % count)
@@ -0,0 +1,48 @@
+from django.db import models
+
+from .settings import inbound_mail_options as option
+
+# Large fields of `InboundMail` that aren't loaded unless requested
+BODY_FIELDS = ('text_body', 'html_body', 'stripped_text_reply')
+
+
+class InboundMailQuerySet(models.QuerySet):
+    def with_bodies(self):
+        """
+        Load the body fields, which are deferred by default. Other fields
+        deferred with `defer()` or `only()` stay deferred.
+        """
+        clone = self._chain()
+        field_names, defer = clone.query.deferred_loading
+        if defer:
+            clone.query.deferred_loading = (frozenset(field_names).difference(BODY_FIELDS), True)
+        else:
+            clone.query.deferred_loading = (frozenset(field_names).union(BODY_FIELDS), False)
+        return clone
+
+    def with_details(self):
+        """
+        Prefetch address details, headers and attachments, so reading or
+        serializing many mails costs a fixed number of queries.
+        """
+        return self.prefetch_related('address_details', 'headers', 'attachments')
+
+    def search(self, query):
+        """
+        Filter mail matching `query` using the full-text search index.
+        """
+        from .search import get_search_backend
+        return get_search_backend(self.db).filter(self, query)
+
+
+class InboundMailManager(models.Manager.from_queryset(InboundMailQuerySet)):
+    """
+    Defers loading the body fields (if the `DEFER_MAIL_BODIES` option is
+    enabled), so listing mail doesn't transfer every body. Use
+    `with_bodies()` to load them.
+    """
+    def get_queryset(self):
+        queryset = super(InboundMailManager, self).get_queryset()
+        if option.DEFER_MAIL_BODIES:
+            queryset = queryset.defer(*BODY_FIELDS)
+        return queryset
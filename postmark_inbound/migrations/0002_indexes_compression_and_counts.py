@@ -0,0 +1,83 @@
+# Generated by Django 2.2.28 on 2026-10-17 21:27
+
+from django.db import migrations, models
+import postmark_inbound.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('postmark_inbound', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboundmail',
+            name='attachment_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='inboundmail',
+            name='compact_headers',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='inboundmail',
+            name='total_attachment_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='inboundmailattachment',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='inboundmail',
+            name='html_body',
+            field=postmark_inbound.fields.CompressedTextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='inboundmail',
+            name='message_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='inboundmail',
+            name='stripped_text_reply',
+            field=postmark_inbound.fields.CompressedTextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='inboundmail',
+            name='text_body',
+            field=postmark_inbound.fields.CompressedTextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='inboundmailheader',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='inboundmail',
+            index=models.Index(fields=['date', 'id'], name='postmark_in_date_b1afcb_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboundmail',
+            index=models.Index(fields=['mailbox_hash', 'date', 'id'], name='postmark_in_mailbox_2c5d57_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboundmail',
+            index=models.Index(fields=['tag', 'date', 'id'], name='postmark_in_tag_883aca_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboundmail',
+            index=models.Index(fields=['from_email', 'date', 'id'], name='postmark_in_from_em_eeaf0c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboundmaildetail',
+            index=models.Index(fields=['email', 'parent_mail'], name='postmark_in_email_f50a94_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='inboundmail',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, message_id=''), fields=('message_id', 'mailbox_hash'), name='postmark_inbound_unique_message_id'),
+        ),
+    ]
@@ -1,8 +1,15 @@
-from django.db import models
-from django.utils.encoding import python_2_unicode_compatible
+import json
 
-from .settings import inbound_mail_options as option
+from django.db import connections, models, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from six import python_2_unicode_compatible
 
+from .fields import CompressedTextField
+from .managers import InboundMailManager
+from .settings import inbound_mail_options as option
 
 @python_2_unicode_compatible
 class InboundMail(models.Model):
@@ -13,44 +20,115 @@ class InboundMail(models.Model):
     bcc_email = models.CharField(blank=True, max_length=255)
     original_recipient = models.CharField(blank=True, max_length=255)
     subject = models.CharField(blank=True, max_length=255)
-    message_id = models.CharField(blank=True, max_length=255)
+    message_id = models.CharField(blank=True, max_length=255, db_index=True)
     reply_to = models.CharField(blank=True, max_length=255)
     mailbox_hash = models.CharField(blank=True, max_length=255)
     date = models.DateTimeField()
-    text_body = models.TextField(blank=True)
-    html_body = models.TextField(blank=True)
-    stripped_text_reply = models.TextField(blank=True)
+    text_body = CompressedTextField(blank=True)
+    html_body = CompressedTextField(blank=True)
+    stripped_text_reply = CompressedTextField(blank=True)
     tag = models.CharField(blank=True, max_length=255)
+    # Denormalised when the mail is created so lists don't query attachments.
+    # NULL for mail saved before these were added, until they are filled in by
+    # the `count_inbound_mail_attachments` management command. The size is the
+    # sum of the attachments' `content_length`.
+    attachment_count = models.PositiveIntegerField(null=True, blank=True)
+    total_attachment_bytes = models.BigIntegerField(null=True, blank=True)
+    # JSON list of [name, value] pairs when headers are stored compactly
+    compact_headers = models.TextField(blank=True)
+
+    objects = InboundMailManager()
+
+    class Meta:
+        # The same message can only be saved once per mailbox hash. Duplicates
+        # across mailboxes are checked by `processing.is_duplicate_mail`
+        # (see the `UNIQUE_MESSAGE_ID_PER_MAILBOX` option). Mail without a
+        # message ID is stored with an empty one, which must not collide.
+        constraints = [
+            models.UniqueConstraint(fields=['message_id', 'mailbox_hash'], condition=~Q(message_id=''),
+                                    name='postmark_inbound_unique_message_id'),
+        ]
+        # Match the filters and `(date, id)` ordering of `InboundMailListView`
+        indexes = [
+            models.Index(fields=['date', 'id']),
+            models.Index(fields=['mailbox_hash', 'date', 'id']),
+            models.Index(fields=['tag', 'date', 'id']),
+            models.Index(fields=['from_email', 'date', 'id']),
+        ]
 
     def __str__(self):
         return ('%s: %s' % (self.from_email, self.subject))
 
     def has_attachment(self):
-        return self.attachments.all().count() > 0
+        if self.attachment_count is None:
+            return self.attachments.exists()
+        return self.attachment_count > 0
     has_attachment.boolean = True
     has_attachment.short_description = 'Attachment'
 
+    def get_headers(self):
+        """
+        Return all headers of the mail, whether they are stored as rows or in
+        `compact_headers`. Compact headers are returned as unsaved
+        `InboundMailHeader` instances.
+        """
+        if self.compact_headers:
+            return [InboundMailHeader(parent_mail=self, name=name, value=value)
+                    for name, value in json.loads(self.compact_headers)]
+        return self.headers.all()
+
+    def _prefetched_details(self, address_type):
+        """
+        Return address details of `address_type` from prefetched rows (see
+        `InboundMailQuerySet.with_details()`), or None if they weren't
+        prefetched.
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'address_details' not in prefetched:
+            return None
+        if not hasattr(self, '_details_by_type'):
+            self._details_by_type = {}
+            for detail in prefetched['address_details']:
+                self._details_by_type.setdefault(detail.address_type, []).append(detail)
+        return self._details_by_type.get(address_type, [])
+
     @property
     def from_full(self):
-        return self.address_details.get(address_type='FROM')
+        details = self._prefetched_details('FROM')
+        if details is None:
+            return self.address_details.get(address_type='FROM')
+        if not details:
+            raise InboundMailDetail.DoesNotExist
+        if len(details) > 1:
+            raise InboundMailDetail.MultipleObjectsReturned
+        return details[0]
 
     @property
     def to_full(self):
-        return self.address_details.filter(address_type='TO')
+        details = self._prefetched_details('TO')
+        if details is None:
+            return self.address_details.filter(address_type='TO')
+        return details
 
     @property
     def cc_full(self):
-        return self.address_details.filter(address_type='CC')
+        details = self._prefetched_details('CC')
+        if details is None:
+            return self.address_details.filter(address_type='CC')
+        return details
 
     @property
     def bcc_full(self):
-        return self.address_details.filter(address_type='BCC')
+        details = self._prefetched_details('BCC')
+        if details is None:
+            return self.address_details.filter(address_type='BCC')
+        return details
 
 
 @python_2_unicode_compatible
 class InboundMailHeader(models.Model):
     parent_mail = models.ForeignKey(InboundMail, related_name='headers', on_delete=models.CASCADE)
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     value = models.TextField(blank=True)
 
     def __str__(self):
@@ -65,11 +143,55 @@ class InboundMailAttachment(models.Model):
     content = models.FileField(upload_to=option.ATTACHMENT_UPLOAD_TO)
     content_id = models.CharField(blank=True, max_length=255)
     content_length = models.IntegerField()
+    # Set when the file is stored by content hash and may be shared
+    content_hash = models.CharField(blank=True, max_length=64, db_index=True)
 
     def __str__(self):
         return ('%s (%s)' % (self.name, self.content_type))
 
 
+def lock_content_hashes(content_hashes, using='default'):
+    """
+    Serialize storing and deleting the shared files of `content_hashes` until
+    the current transaction ends, using advisory locks on PostgreSQL. Other
+    databases rely on `serializers.restore_attachment_file()` writing files
+    deleted while mail referring to them was being saved.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        # In a fixed order, so concurrent transactions don't deadlock
+        for content_hash in sorted(content_hashes):
+            cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', [content_hash])
+
+
+def delete_unreferenced_attachment_file(storage, name, content_hash, using='default'):
+    """
+    Delete a content-addressed attachment file once no attachment refers to it.
+    """
+    with transaction.atomic(using=using):
+        lock_content_hashes([content_hash], using)
+        if not (InboundMailAttachment.objects.using(using)
+                .filter(content_hash=content_hash, content=name).exists()):
+            storage.delete(name)
+
+
+@receiver(post_delete, sender=InboundMail)
+def remove_mail_from_search_index(sender, instance, using, **kwargs):
+    from .search import get_search_backend
+    get_search_backend(using).remove([instance.pk])
+
+
+@receiver(post_delete, sender=InboundMailAttachment)
+def delete_attachment_content(sender, instance, using, **kwargs):
+    if instance.content_hash and instance.content:
+        storage, name = instance.content.storage, instance.content.name
+        transaction.on_commit(
+            lambda: delete_unreferenced_attachment_file(storage, name, instance.content_hash, using),
+            using=using)
+
+
 # Declare sources of email addresses
 ADDRESS_TYPES = tuple(map(lambda x: (x, x), ['FROM', 'TO', 'CC', 'BCC']))
 
@@ -82,5 +204,10 @@ class InboundMailDetail(models.Model):
     name = models.CharField(blank=True, max_length=255)
     mailbox_hash = models.CharField(blank=True, max_length=255)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['email', 'parent_mail']),
+        ]
+
     def __str__(self):
         return ('%s (%s)' % (self.email, self.address_type))
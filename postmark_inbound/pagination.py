@@ -0,0 +1,77 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate inbound mail by `(date, id)`, newest first (or oldest first with
+    `?ordering=date`). Each page continues from the last mail of the previous
+    one instead of using an offset, so every page costs the same to fetch.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def encode_cursor(self, instance):
+        position = '%s|%d' % (instance.date.isoformat(), instance.pk)
+        return urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        try:
+            date, pk = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            date, pk = parse_datetime(date), int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return date, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        ascending = request.query_params.get(self.ordering_query_param) == 'date'
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            date, pk = self.decode_cursor(encoded)
+            # The plain date bound lets the database use an index range scan
+            if ascending:
+                queryset = queryset.filter(Q(date__gt=date) | Q(date=date, pk__gt=pk), date__gte=date)
+            else:
+                queryset = queryset.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk), date__lte=date)
+
+        ordering = ('date', 'id') if ascending else ('-date', '-id')
+        results = list(queryset.order_by(*ordering)[:page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
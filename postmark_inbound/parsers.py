@@ -4,7 +4,11 @@ import re
 
 from django.conf import settings
 
-from rest_framework.parsers import JSONParser, ParseError, six
+import six
+from rest_framework.parsers import JSONParser, ParseError
+
+from .settings import inbound_mail_options as option
+from .utils import is_spoolable_attachment, spool_base64_file
 
 
 # Parser logic taken from vbabiy's djangorestframework-camel-case project
@@ -13,20 +17,93 @@ from rest_framework.parsers import JSONParser, ParseError, six
 first_cap_re = re.compile('(.)([A-Z][a-z]+)')
 all_cap_re = re.compile('([a-z0-9])([A-Z])')
 
+# Keys that clash with Python keywords/model fields and are suffixed with "Email"
+EMAIL_SUFFIXED_KEYS = ('From', 'To', 'Cc', 'Bcc')
+
+# Field names found in Postmark's inbound JSON, translated ahead of time so the
+# common case never touches the regular expressions
+POSTMARK_FIELD_NAMES = (
+    'FromName', 'From', 'FromFull', 'To', 'ToFull', 'Cc', 'CcFull', 'Bcc',
+    'BccFull', 'OriginalRecipient', 'Subject', 'MessageID', 'ReplyTo',
+    'MailboxHash', 'Date', 'TextBody', 'HtmlBody', 'StrippedTextReply', 'Tag',
+    'Headers', 'Attachments', 'Email', 'Name', 'Value', 'Content',
+    'ContentType', 'ContentLength', 'ContentID')
+
+# Upper bound on memoized keys that are not part of Postmark's documented payload
+KEY_CACHE_SIZE = 1024
+
 
 def camel_to_underscore(name):
     s1 = first_cap_re.sub(r'\1_\2', name)
     return all_cap_re.sub(r'\1_\2', s1).lower()
 
 
+def _translate_key(key):
+    if key in EMAIL_SUFFIXED_KEYS:
+        key = key + 'Email'
+    return camel_to_underscore(key)
+
+
+_key_cache = dict((key, _translate_key(key)) for key in POSTMARK_FIELD_NAMES)
+
+
+def underscore_key(key):
+    """
+    Return the model/serializer field name for a Postmark JSON key, using the
+    precomputed translation table where possible.
+    """
+    try:
+        return _key_cache[key]
+    except KeyError:
+        new_key = _translate_key(key)
+        if len(_key_cache) < len(POSTMARK_FIELD_NAMES) + KEY_CACHE_SIZE:
+            _key_cache[key] = new_key
+        return new_key
+
+
+# Postmark JSON keys by model/serializer field name, for writing payloads
+_postmark_keys = dict((_key_cache[key], key) for key in POSTMARK_FIELD_NAMES)
+
+
+def postmark_key(name):
+    """
+    Return the Postmark JSON key for a model/serializer field name.
+    """
+    return _postmark_keys[name]
+
+
+def underscoreize_pairs(pairs):
+    """
+    `object_pairs_hook` for `json.loads()` that renames keys as each JSON
+    object is decoded, avoiding a second walk over the parsed data.
+    """
+    return dict((underscore_key(key), value) for key, value in pairs)
+
+
+def spooling_pairs_hook(threshold):
+    """
+    Return an `object_pairs_hook` that also decodes large attachments to a
+    temporary file as soon as each attachment object has been parsed, so the
+    base64 string can be released before the rest of the payload is decoded.
+    """
+    def hook(pairs):
+        data = underscoreize_pairs(pairs)
+        if is_spoolable_attachment(data, threshold):
+            try:
+                data['content'] = spool_base64_file(data['content'], data['content_type'],
+                                                    data.get('name'))
+            except (TypeError, ValueError):
+                # Leave the content as-is for the serializer to report
+                pass
+        return data
+    return hook
+
+
 def underscoreize(data):
     if isinstance(data, dict):
         new_dict = {}
         for key, value in data.items():
-            if key in ['From', 'To', 'Cc', 'Bcc']:
-                key = key + 'Email'
-            new_key = camel_to_underscore(key)
-            new_dict[new_key] = underscoreize(value)
+            new_dict[underscore_key(key)] = underscoreize(value)
         return new_dict
     if isinstance(data, (list, tuple)):
         for i in range(len(data)):
@@ -42,9 +119,14 @@ class PostmarkJSONParser(JSONParser):
     def parse(self, stream, media_type=None, parser_context=None):
         parser_context = parser_context or {}
         encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        threshold = option.ATTACHMENT_SPOOL_THRESHOLD
+        if threshold is None:
+            object_pairs_hook = underscoreize_pairs
+        else:
+            object_pairs_hook = spooling_pairs_hook(threshold)
 
         try:
             data = stream.read().decode(encoding)
-            return underscoreize(json.loads(data))
+            return json.loads(data, object_pairs_hook=object_pairs_hook)
         except ValueError as exc:
             raise ParseError('JSON parse error - %s' % six.text_type(exc))
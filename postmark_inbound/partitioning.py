@@ -0,0 +1,282 @@
+"""
+Monthly partitioning of `InboundMail` by `date`, using PostgreSQL (11+)
+declarative partitioning. Managed with the `partition_inbound_mail`
+management command.
+
+PostgreSQL routes inserts to the partition of the mail's date, and skips
+partitions that can't match a date filter when reading, so no database
+router is needed. The existing table becomes the first partition (for all
+dates before the month after its newest mail), new mail goes to monthly
+partitions, and mail with dates outside the created partitions goes to a
+default partition.
+
+Because the primary key of a partitioned table has to include the
+partition key, it becomes `(id, date)`. `id` stays unique as it comes from
+a sequence, but foreign keys can no longer reference the mail table, so
+they are dropped from the related tables. For the same reason message IDs
+can't be unique in the database, and their unique constraint is dropped
+(duplicates are still ignored, see `processing.is_duplicate_mail`).
+"""
+import re
+from datetime import date
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import InboundMail
+from .retention import delete_mail
+from .settings import inbound_mail_options as option
+
+partition_suffix_re = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_table():
+    return InboundMail._meta.db_table
+
+
+def partition_name(month):
+    return '%s_p%04d%02d' % (get_table(), month.year, month.month)
+
+
+def partition_month(name):
+    """
+    Return the month of a partition from its name, or None for the legacy
+    and default partitions.
+    """
+    match = partition_suffix_re.search(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def bound(month):
+    # Month boundaries are in UTC whatever the session time zone is
+    return "'%s+00'" % month.strftime('%Y-%m-%d 00:00:00')
+
+
+def check_connection(connection):
+    if connection.vendor != 'postgresql' or connection.pg_version < 110000:
+        raise PartitioningError('Partitioning inbound mail requires PostgreSQL 11 or later.')
+
+
+def is_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+                       [get_table()])
+        return cursor.fetchone() is not None
+
+
+def get_partitions(connection):
+    """
+    Return the names of the partitions of the mail table.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                       'WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname', [get_table()])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def get_detached_partitions(connection):
+    """
+    Return the names of monthly partitions that have been detached from the
+    mail table but not dropped.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition "
+                       'AND relnamespace = to_regnamespace(current_schema()) AND starts_with(relname, %s) '
+                       'ORDER BY relname', [get_table() + '_p'])
+        return [row[0] for row in cursor.fetchall() if partition_month(row[0]) is not None]
+
+
+def get_index_columns(connection):
+    """
+    Return the column lists of the indexes Django creates on the mail table,
+    other than for the primary key and unique constraints.
+    """
+    quote_name = connection.ops.quote_name
+    columns = [[quote_name(field.column)] for field in InboundMail._meta.local_fields
+               if field.db_index and not field.unique]
+    for index in InboundMail._meta.indexes:
+        columns.append([
+            '%s DESC' % quote_name(InboundMail._meta.get_field(name[1:]).column) if name.startswith('-')
+            else quote_name(InboundMail._meta.get_field(name).column)
+            for name in index.fields])
+    return columns
+
+
+def convert_statements(connection, first_month, foreign_keys):
+    """
+    Return the statements converting the mail table to a partitioned table,
+    with the existing table as the partition for dates before `first_month`.
+    """
+    quote_name = connection.ops.quote_name
+    table = get_table()
+    legacy = table + '_legacy'
+    statements = []
+    for related_table, constraint in foreign_keys:
+        statements.append('ALTER TABLE %s DROP CONSTRAINT %s' % (quote_name(related_table), quote_name(constraint)))
+    # Conditional unique constraints are created as unique indexes
+    for constraint in InboundMail._meta.constraints:
+        statements.append('DROP INDEX IF EXISTS %s' % quote_name(constraint.name))
+    statements += [
+        'ALTER TABLE %s RENAME TO %s' % (quote_name(table), quote_name(legacy)),
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (%s)' % (
+            quote_name(table), quote_name(legacy), quote_name('date')),
+        'ALTER TABLE %s ADD PRIMARY KEY (%s, %s)' % (quote_name(table), quote_name('id'), quote_name('date')),
+    ]
+    # Unnamed, so they don't clash with the indexes of the legacy table,
+    # which are attached to them
+    for columns in get_index_columns(connection):
+        statements.append('CREATE INDEX ON %s (%s)' % (quote_name(table), ', '.join(columns)))
+    statements += [
+        # Sequence ownership moves with the column
+        'ALTER SEQUENCE %s OWNED BY %s.%s' % (quote_name(table + '_id_seq'), quote_name(table), quote_name('id')),
+        'ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%s)' % (
+            quote_name(table), quote_name(legacy), bound(first_month)),
+        'CREATE TABLE %s PARTITION OF %s DEFAULT' % (quote_name(table + '_default'), quote_name(table)),
+    ]
+    return statements
+
+
+def create_partition_statements(connection, month):
+    """
+    Return the statements creating the partition for `month`, moving any
+    of its mail from the default partition.
+    """
+    quote_name = connection.ops.quote_name
+    table, name = get_table(), partition_name(month)
+    default, moved = table + '_default', name + '_moved'
+    date_range = '%s >= %s AND %s < %s' % (
+        quote_name('date'), bound(month), quote_name('date'), bound(add_months(month, 1)))
+    return [
+        'CREATE TEMPORARY TABLE %s (LIKE %s) ON COMMIT DROP' % (quote_name(moved), quote_name(table)),
+        'WITH rows AS (DELETE FROM %s WHERE %s RETURNING *) INSERT INTO %s SELECT * FROM rows' % (
+            quote_name(default), date_range, quote_name(moved)),
+        'CREATE TABLE %s PARTITION OF %s FOR VALUES FROM (%s) TO (%s)' % (
+            quote_name(name), quote_name(table), bound(month), bound(add_months(month, 1))),
+        'INSERT INTO %s SELECT * FROM %s' % (quote_name(table), quote_name(moved)),
+    ]
+
+
+def convert_to_partitioned(using='default'):
+    """
+    Convert the mail table to a partitioned table. The existing table is
+    attached as a single partition, which is checked in one scan.
+    """
+    connection = connections[using]
+    check_connection(connection)
+    if is_partitioned(connection):
+        raise PartitioningError('%s is already partitioned.' % get_table())
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute('SELECT max(%s) FROM %s' % (
+            connection.ops.quote_name('date'), connection.ops.quote_name(get_table())))
+        newest = cursor.fetchone()[0] or timezone.now()
+        first_month = add_months(month_start(newest.astimezone(timezone.utc)), 1)
+
+        cursor.execute('SELECT conrelid::regclass::text, conname FROM pg_constraint '
+                       "WHERE contype = 'f' AND confrelid = to_regclass(%s)", [get_table()])
+        foreign_keys = cursor.fetchall()
+
+        for statement in convert_statements(connection, first_month, foreign_keys):
+            cursor.execute(statement)
+    return first_month
+
+
+def create_partitions(months_ahead, using='default', now=None):
+    """
+    Create the partitions for the current month and `months_ahead` months
+    after it, if they don't exist. Returns the names of the new partitions.
+    """
+    connection = connections[using]
+    check_connection(connection)
+    if not is_partitioned(connection):
+        raise PartitioningError('%s is not partitioned yet.' % get_table())
+
+    existing = set(get_partitions(connection))
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_class c WHERE c.oid = to_regclass(%s)',
+                       [get_table() + '_legacy'])
+        row = cursor.fetchone()
+    # Months covered by the legacy partition can't have their own partition
+    first_month = None
+    if row is not None:
+        match = re.search(r"TO \('(\d{4})-(\d{2})-", row[0] or '')
+        if match:
+            first_month = date(int(match.group(1)), int(match.group(2)), 1)
+
+    current = month_start((now or timezone.now()).astimezone(timezone.utc))
+    created = []
+    for i in range(months_ahead + 1):
+        month = add_months(current, i)
+        if partition_name(month) in existing or (first_month and month < first_month):
+            continue
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            for statement in create_partition_statements(connection, month):
+                cursor.execute(statement)
+        created.append(partition_name(month))
+    return created
+
+
+def drop_partition(name, using='default', detach_only=False, batch_size=None):
+    """
+    Detach a monthly partition, removing its mail from the mail table in one
+    operation. Unless `detach_only` is True, the related rows, search
+    documents and attachment files of its mail are then deleted in batches
+    of `batch_size` (`PURGE_BATCH_SIZE` by default), and the partition
+    dropped.
+
+    Partitions detached earlier (e.g. with `detach_only`, or by a drop that
+    was interrupted) can be dropped the same way.
+    """
+    connection = connections[using]
+    check_connection(connection)
+    attached = name in get_partitions(connection)
+    if partition_month(name) is None or not (attached or name in get_detached_partitions(connection)):
+        raise PartitioningError('%s is not a monthly partition of %s.' % (name, get_table()))
+
+    quote_name = connection.ops.quote_name
+    if attached:
+        # Committed on its own, as it locks the mail table against new mail
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (quote_name(get_table()), quote_name(name)))
+    if detach_only:
+        return
+
+    batch_size = batch_size or option.PURGE_BATCH_SIZE
+    last_pk = 0
+    with connection.cursor() as cursor:
+        while True:
+            cursor.execute('SELECT %s FROM %s WHERE %s > %%s ORDER BY %s LIMIT %%s' % (
+                quote_name('id'), quote_name(name), quote_name('id'), quote_name('id')), [last_pk, batch_size])
+            batch = [row[0] for row in cursor.fetchall()]
+            if not batch:
+                break
+            delete_mail(batch, using, related_only=True)
+            last_pk = batch[-1]
+        cursor.execute('DROP TABLE %s' % quote_name(name))
+
+
+def partitions_before(month, using='default', include_detached=False):
+    """
+    Return the names of the monthly partitions for months before `month`,
+    including detached ones if `include_detached` is True.
+    """
+    connection = connections[using]
+    names = get_partitions(connection)
+    if include_detached:
+        names = sorted(names + get_detached_partitions(connection))
+    return [name for name in names if partition_month(name) is not None and partition_month(name) < month]
@@ -0,0 +1,227 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.db import IntegrityError, connection, transaction
+from six import BytesIO
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+from .dispatch import get_dispatcher, send_robust_async
+from .instrumentation import null_timer
+from .models import InboundMail
+from .parsers import PostmarkJSONParser
+from .serializers import InboundMailSerializer
+from .signals import inbound_mail_received
+from .settings import inbound_mail_options as option
+from .utils import LRUCache
+from .validation import FastInboundMailSerializer
+
+# Message IDs saved or seen recently by this process, to answer webhook
+# retries from Postmark without a database query
+recent_message_ids = LRUCache(option.RECENT_MESSAGE_ID_CACHE_SIZE)
+
+
+def remember_message_key(key):
+    """
+    Add `key` to `recent_message_ids` once the current transaction commits, so
+    mail that is rolled back isn't taken for a duplicate.
+    """
+    transaction.on_commit(lambda: recent_message_ids.set(key))
+
+
+def get_message_id_fields():
+    """
+    Return the fields identifying a unique inbound mail.
+    """
+    if option.UNIQUE_MESSAGE_ID_PER_MAILBOX:
+        return ('message_id', 'mailbox_hash')
+    return ('message_id',)
+
+
+def get_message_key(data, fields=None):
+    """
+    Return the values of `fields` (by default those identifying a unique
+    mail) in parsed inbound mail data, or None if the mail has no message ID.
+    """
+    if not data.get('message_id'):
+        return None
+    return tuple(data.get(field) or '' for field in fields or get_message_id_fields())
+
+
+def is_saved_mail(data, fields):
+    key = get_message_key(data, fields)
+    return key is not None and InboundMail.objects.filter(**dict(zip(fields, key))).exists()
+
+
+def is_duplicate_mail(data):
+    """
+    Check whether inbound mail with the same message ID has already been saved.
+    """
+    if not (option.UNIQUE_MESSAGE_ID and option.SAVE_MAIL_TO_DB):
+        return False
+
+    key = get_message_key(data)
+    if key is None:
+        return False
+    if key in recent_message_ids:
+        return True
+
+    duplicate = is_saved_mail(data, get_message_id_fields())
+    if duplicate:
+        remember_message_key(key)
+    return duplicate
+
+
+class DuplicateInboundMail(Exception):
+    """
+    Raised when mail is found to have been saved by a concurrent request.
+    """
+
+
+def save_inbound_mail(serializer, data):
+    """
+    Save validated inbound mail, remembering its message ID.
+    """
+    try:
+        mail_object = serializer.save()
+    except IntegrityError:
+        # The same mail may have been saved by a concurrent request. The
+        # database rejects mail already saved to the same mailbox hash even
+        # if `UNIQUE_MESSAGE_ID` is disabled.
+        if is_duplicate_mail(data) or is_saved_mail(data, ('message_id', 'mailbox_hash')):
+            raise DuplicateInboundMail()
+        raise
+    key = get_message_key(data)
+    if key is not None:
+        remember_message_key(key)
+    return mail_object
+
+
+def get_serializer_class():
+    if option.FAST_VALIDATION:
+        return FastInboundMailSerializer
+    return InboundMailSerializer
+
+
+def process_inbound_mail(data, sender, send_signal=True, timer=None):
+    """
+    Validate parsed inbound mail data from Postmark, save it to the database
+    (if enabled) and send the `inbound_mail_received` signal (unless
+    `send_signal` is False). Stage durations are recorded on `timer`, a
+    `RequestTimer`, if given.
+
+    Mail that has already been received is ignored, in which case None is
+    returned and no signal is sent. Raises `ValidationError` if the data is
+    invalid.
+    """
+    # Check for duplicates before attachments are validated and stored
+    if is_duplicate_mail(data):
+        return None
+
+    timer = timer or null_timer
+    serializer = get_serializer_class()(data=data, context={'timer': timer})
+    with timer.stage('validate'):
+        serializer.is_valid(raise_exception=True)
+
+    mail_data = serializer.validated_data
+    timer.record_attachments(mail_data.get('attachments', []))
+    mail_object = None
+    if option.SAVE_MAIL_TO_DB:
+        try:
+            mail_object = save_inbound_mail(serializer, data)
+        except DuplicateInboundMail:
+            return None
+
+    # Send signal notifying that a new inbound mail has been received
+    if send_signal:
+        with timer.stage('signal'):
+            if option.SIGNAL_DISPATCH == 'deferred':
+                get_dispatcher(inbound_mail_received).send(sender=sender,
+                                                           mail_data=mail_data,
+                                                           mail_object=mail_object)
+            else:
+                inbound_mail_received.send_robust(sender=sender,
+                                                  mail_data=mail_data,
+                                                  mail_object=mail_object)
+    return mail_object
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Return the process-wide thread pool used by `aprocess_inbound_mail()` for
+    parsing and validation.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=option.ASYNC_WORKERS,
+                                           thread_name_prefix='postmark-inbound')
+        return _executor
+
+
+def parse_inbound_mail(body):
+    return PostmarkJSONParser().parse(BytesIO(body))
+
+
+def run_timed(timer, stage, func, *args):
+    with timer.stage(stage):
+        return func(*args)
+
+
+def run_counting_queries(timer, func, *args):
+    if timer is null_timer:
+        return func(*args)
+    with timer.count_queries(connection):
+        return func(*args)
+
+
+async def aprocess_inbound_mail(body, sender, timer=None):
+    """
+    Async version of `process_inbound_mail()` taking the raw request body.
+
+    Parsing and validation (including base64 decoding) run on a bounded
+    thread pool (`ASYNC_WORKERS`), and database and storage writes through
+    `sync_to_async`. Receivers of `inbound_mail_received` may be coroutine
+    functions, which are awaited.
+    """
+    loop = asyncio.get_event_loop()
+    executor = get_executor()
+    timer = timer or null_timer
+
+    data = await loop.run_in_executor(executor, run_timed, timer, 'parse', parse_inbound_mail, body)
+
+    # Check for duplicates before attachments are validated and stored
+    if await sync_to_async(run_counting_queries)(timer, is_duplicate_mail, data):
+        return None
+
+    serializer = get_serializer_class()(data=data, context={'timer': timer})
+    await loop.run_in_executor(executor, run_timed, timer, 'validate',
+                               partial(serializer.is_valid, raise_exception=True))
+
+    mail_data = serializer.validated_data
+    timer.record_attachments(mail_data.get('attachments', []))
+    mail_object = None
+    if option.SAVE_MAIL_TO_DB:
+        try:
+            mail_object = await sync_to_async(run_counting_queries)(timer, save_inbound_mail, serializer, data)
+        except DuplicateInboundMail:
+            return None
+
+    # Send signal notifying that a new inbound mail has been received
+    with timer.stage('signal'):
+        if option.SIGNAL_DISPATCH == 'deferred':
+            await sync_to_async(get_dispatcher(inbound_mail_received).send)(
+                sender=sender, mail_data=mail_data, mail_object=mail_object)
+        else:
+            await send_robust_async(inbound_mail_received, sender=sender,
+                                    mail_data=mail_data, mail_object=mail_object)
+    return mail_object
@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import (InboundMail, InboundMailAttachment, InboundMailDetail, InboundMailHeader,
+                     lock_content_hashes)
+from .search import get_search_backend
+
+
+def expired_mail_filter(days=None, max_count=None, now=None, using='default'):
+    """
+    Return a `Q` object matching mail older than `days`, and/or mail beyond
+    the `max_count` most recent, or None if no limit is given.
+    """
+    filters = []
+    if days is not None:
+        filters.append(Q(date__lt=(now or timezone.now()) - timedelta(days=days)))
+    if max_count is not None:
+        newest = (InboundMail.objects.using(using).order_by('-date', '-pk')
+                  .values_list('date', 'pk')[max_count:max_count + 1])
+        if newest:
+            date, pk = newest[0]
+            filters.append(Q(date__lt=date) | Q(date=date, pk__lte=pk))
+        else:
+            filters.append(Q(pk__in=[]))
+
+    if not filters:
+        return None
+    expired = filters[0]
+    for f in filters[1:]:
+        expired |= f
+    return expired
+
+
+def delete_mail(mail_ids, using='default', related_only=False):
+    """
+    Delete mail and all related rows with one `DELETE` statement per table,
+    bypassing the ORM's cascade collection. Attachment files are deleted from
+    storage after the transaction is committed; content-addressed files are
+    only deleted once no remaining attachment refers to them.
+
+    With `related_only`, the mail rows themselves are left (e.g. for mail in
+    a partition that has been detached, see `partitioning.drop_partition()`).
+    """
+    mail_ids = list(mail_ids)
+    if not mail_ids:
+        return
+
+    attachments = list(InboundMailAttachment.objects.using(using)
+                       .filter(parent_mail_id__in=mail_ids)
+                       .values_list('content', 'content_hash'))
+
+    connection = connections[using]
+    placeholders = ', '.join(['%s'] * len(mail_ids))
+    with transaction.atomic(using=using):
+        get_search_backend(using).remove(mail_ids)
+        with connection.cursor() as cursor:
+            tables = [(InboundMailHeader, 'parent_mail_id'),
+                      (InboundMailDetail, 'parent_mail_id'),
+                      (InboundMailAttachment, 'parent_mail_id')]
+            if not related_only:
+                tables.append((InboundMail, 'id'))
+            for model, column in tables:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                    connection.ops.quote_name(model._meta.db_table),
+                    connection.ops.quote_name(column), placeholders), mail_ids)
+
+    delete_attachment_files(attachments, using)
+
+
+def delete_attachment_files(attachments, using='default'):
+    storage = InboundMailAttachment._meta.get_field('content').storage
+    for name in set(name for name, content_hash in attachments if name and not content_hash):
+        storage.delete(name)
+
+    shared = set((name, content_hash) for name, content_hash in attachments if name and content_hash)
+    if not shared:
+        return
+    hashes = set(content_hash for name, content_hash in shared)
+    with transaction.atomic(using=using):
+        # Keep shared files that are still referenced, without racing mail
+        # being saved with the same attachments
+        lock_content_hashes(hashes, using)
+        referenced = set(InboundMailAttachment.objects.using(using)
+                         .filter(content_hash__in=hashes)
+                         .values_list('content', flat=True))
+        for name in set(name for name, content_hash in shared) - referenced:
+            storage.delete(name)
@@ -0,0 +1,169 @@
+"""
+Route inbound mail to handlers by mailbox hash, recipient or tag.
+
+    from postmark_inbound.routing import route
+
+    @route(mailbox_hash='tenant-42')
+    def handle_tenant_42(sender, mail_data, mail_object, **kwargs):
+        ...
+
+Handlers are kept in dictionaries keyed by the value they route on, so
+dispatching a mail only looks at the handlers registered for its mailbox
+hash, recipients and tag, rather than calling every handler. Handlers
+registered with `route()` without arguments are called for mail no other
+route matched.
+"""
+import logging
+import threading
+from email.utils import getaddresses
+
+logger = logging.getLogger(__name__)
+
+# Keys in order of preference for indexing a route with several criteria
+ROUTE_KEYS = ('mailbox_hash', 'to', 'tag')
+
+
+class Route(object):
+    __slots__ = ('handler', 'criteria', 'name', 'calls', 'failures')
+
+    def __init__(self, handler, criteria):
+        self.handler = handler
+        self.criteria = criteria
+        self.name = ','.join('%s=%s' % (key, criteria[key]) for key in ROUTE_KEYS if key in criteria) or '*'
+        self.calls = self.failures = 0
+
+    def matches(self, values):
+        return all(value in values[key] for key, value in self.criteria.items())
+
+
+class InboundMailRouter(object):
+    """
+    Registry of inbound mail handlers, dispatching each mail received to the
+    handlers whose criteria match it.
+    """
+    def __init__(self):
+        self._tables = dict((key, {}) for key in ROUTE_KEYS)
+        self._catch_all = []
+        self._lock = threading.Lock()
+
+    def route(self, mailbox_hash=None, to=None, tag=None):
+        """
+        Decorator registering a handler for mail matching all of the given
+        criteria. Recipient addresses are compared case-insensitively.
+        """
+        criteria = dict((key, value) for key, value in (
+            ('mailbox_hash', mailbox_hash), ('to', to and to.lower()), ('tag', tag)) if value is not None)
+
+        def decorator(handler):
+            self.register(handler, **criteria)
+            return handler
+        return decorator
+
+    def register(self, handler, **criteria):
+        route = Route(handler, criteria)
+        with self._lock:
+            for key in ROUTE_KEYS:
+                if key in criteria:
+                    self._tables[key].setdefault(criteria[key], []).append(route)
+                    break
+            else:
+                self._catch_all.append(route)
+        return route
+
+    def disconnect(self, handler):
+        """
+        Remove every route of `handler`.
+        """
+        with self._lock:
+            for table in self._tables.values():
+                for value, routes in list(table.items()):
+                    routes[:] = [route for route in routes if route.handler != handler]
+                    if not routes:
+                        del table[value]
+            self._catch_all = [route for route in self._catch_all if route.handler != handler]
+
+    def clear(self):
+        with self._lock:
+            for table in self._tables.values():
+                table.clear()
+            self._catch_all = []
+
+    def get_recipients(self, mail_data):
+        """
+        Return the lowercased To, Cc and Bcc addresses of `mail_data`, taken
+        from the parsed `*_full` lists, or from the header values for mail
+        data without them.
+        """
+        recipients = set()
+        for address_type in ('to', 'cc', 'bcc'):
+            if address_type + '_full' in mail_data:
+                addresses = [detail.get('email') for detail in mail_data[address_type + '_full'] or ()]
+            else:
+                addresses = [address for name, address in getaddresses([mail_data.get(address_type + '_email') or ''])]
+            recipients.update(address.lower() for address in addresses if address)
+        return recipients
+
+    def get_route_values(self, mail_data):
+        recipients = self.get_recipients(mail_data)
+        if mail_data.get('original_recipient'):
+            recipients.add(mail_data['original_recipient'].lower())
+        return {
+            'mailbox_hash': set([mail_data.get('mailbox_hash') or '']),
+            'to': recipients,
+            'tag': set([mail_data.get('tag') or '']),
+        }
+
+    def resolve(self, mail_data):
+        """
+        Return the routes matching `mail_data`, or the catch-all routes if
+        there are none.
+        """
+        values = self.get_route_values(mail_data)
+        matched = []
+        for key in ROUTE_KEYS:
+            table = self._tables[key]
+            if not table:
+                continue
+            for value in values[key]:
+                for route in table.get(value, ()):
+                    if route.matches(values):
+                        matched.append(route)
+        return matched or list(self._catch_all)
+
+    def dispatch(self, sender, mail_data, mail_object=None, **kwargs):
+        """
+        Call the handlers matching `mail_data`. Exceptions raised by handlers
+        are logged, and don't stop other handlers being called.
+        """
+        for route in self.resolve(mail_data):
+            try:
+                route.handler(sender=sender, mail_data=mail_data, mail_object=mail_object)
+            except Exception:
+                with self._lock:
+                    route.calls += 1
+                    route.failures += 1
+                logger.exception('Inbound mail handler for route %s raised an exception', route.name)
+            else:
+                with self._lock:
+                    route.calls += 1
+
+    def stats(self):
+        """
+        Return the number of calls and failures of each route, by route name.
+        """
+        stats = {}
+        with self._lock:
+            routes = [route for table in self._tables.values() for routes in table.values() for route in routes]
+            for route in routes + self._catch_all:
+                counters = stats.setdefault(route.name, {'calls': 0, 'failures': 0})
+                counters['calls'] += route.calls
+                counters['failures'] += route.failures
+        return stats
+
+
+router = InboundMailRouter()
+route = router.route
+
+
+def route_inbound_mail(sender, mail_data, mail_object=None, **kwargs):
+    router.dispatch(sender, mail_data, mail_object)
@@ -0,0 +1,146 @@
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .settings import inbound_mail_options as option
+
+# Fields of `InboundMail` covered by the full-text index
+SEARCH_FIELDS = ('subject', 'from_email', 'text_body', 'stripped_text_reply')
+
+
+class DatabaseSearchBackend(object):
+    """
+    Fallback for databases without full-text search support, matching each
+    search term against the search fields with `icontains`. Bodies stored
+    compressed (see `BODY_COMPRESSION_THRESHOLD`) are not matched.
+    """
+    table_suffix = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @property
+    def table(self):
+        from .models import InboundMail
+        return InboundMail._meta.db_table + self.table_suffix
+
+    def install(self):
+        pass
+
+    def index(self, mails):
+        pass
+
+    def remove(self, mail_ids):
+        pass
+
+    def filter(self, queryset, query):
+        for term in query.split():
+            term_filter = Q()
+            for field in SEARCH_FIELDS:
+                term_filter |= Q(**{'%s__icontains' % field: term})
+            queryset = queryset.filter(term_filter)
+        return queryset
+
+
+class SQLiteSearchBackend(DatabaseSearchBackend):
+    """
+    Full-text search using an SQLite FTS5 table, with the mail ID as rowid.
+    """
+    table_suffix = '_fts'
+
+    def install(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s)' % (
+                self.connection.ops.quote_name(self.table), ', '.join(SEARCH_FIELDS)))
+
+    def index(self, mails):
+        table = self.connection.ops.quote_name(self.table)
+        with self.connection.cursor() as cursor:
+            # FTS5 tables don't enforce unique rowids, so replace by hand
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % table,
+                               [(mail.pk,) for mail in mails])
+            cursor.executemany('INSERT INTO %s (rowid, %s) VALUES (%%s, %s)' % (
+                table, ', '.join(SEARCH_FIELDS), ', '.join(['%s'] * len(SEARCH_FIELDS))),
+                [[mail.pk] + [getattr(mail, field) for field in SEARCH_FIELDS] for mail in mails])
+
+    def remove(self, mail_ids):
+        table = self.connection.ops.quote_name(self.table)
+        with self.connection.cursor() as cursor:
+            cursor.executemany('DELETE FROM %s WHERE rowid = %%s' % table,
+                               [(mail_id,) for mail_id in mail_ids])
+
+    def filter(self, queryset, query):
+        # Quote each term so FTS5 query syntax in the input is matched literally
+        terms = ['"%s"' % term.replace('"', '""') for term in query.split()]
+        if not terms:
+            return queryset
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (
+            (self.connection.ops.quote_name(self.table),) * 2)
+        return queryset.filter(pk__in=RawSQL(sql, [' '.join(terms)]))
+
+
+class PostgreSQLSearchBackend(DatabaseSearchBackend):
+    """
+    Full-text search using a `tsvector` document per mail in a separate table
+    with a GIN index. Documents are removed by the database when the mail is
+    deleted.
+    """
+    table_suffix = '_search'
+
+    def install(self):
+        from .models import InboundMail
+        quote_name = self.connection.ops.quote_name
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'mail_id integer PRIMARY KEY REFERENCES %s (id) ON DELETE CASCADE, '
+                'document tsvector NOT NULL)' % (
+                    quote_name(self.table), quote_name(InboundMail._meta.db_table)))
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s USING GIN (document)' % (
+                quote_name(self.table + '_document'), quote_name(self.table)))
+
+    def index(self, mails):
+        document = " || ' ' || ".join(['coalesce(%s, \'\')'] * len(SEARCH_FIELDS))
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO %s (mail_id, document) VALUES (%%s, to_tsvector(%%s, %s)) '
+                'ON CONFLICT (mail_id) DO UPDATE SET document = EXCLUDED.document' % (
+                    self.connection.ops.quote_name(self.table), document),
+                [[mail.pk, option.SEARCH_CONFIG] + [getattr(mail, field) for field in SEARCH_FIELDS]
+                 for mail in mails])
+
+    def remove(self, mail_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE mail_id = ANY(%%s)' % (
+                self.connection.ops.quote_name(self.table)), [list(mail_ids)])
+
+    def filter(self, queryset, query):
+        if not query.strip():
+            return queryset
+        sql = 'SELECT mail_id FROM %s WHERE document @@ plainto_tsquery(%%s, %%s)' % (
+            self.connection.ops.quote_name(self.table))
+        return queryset.filter(pk__in=RawSQL(sql, [option.SEARCH_CONFIG, query]))
+
+
+SEARCH_BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgreSQLSearchBackend,
+}
+
+
+def get_search_backend(using='default'):
+    """
+    Return the full-text search backend for the database alias `using`.
+    """
+    connection = connections[using]
+    backend_class = DatabaseSearchBackend
+    if option.FULL_TEXT_SEARCH:
+        backend_class = SEARCH_BACKENDS.get(connection.vendor, DatabaseSearchBackend)
+    return backend_class(connection)
+
+
+def install_search_index(using='default', **kwargs):
+    """
+    `post_migrate` receiver creating the full-text search tables.
+    """
+    get_search_backend(using).install()
@@ -1,25 +1,40 @@
+import json
+import logging
+import os
 import uuid
-from base64 import b64decode, b64encode
-from mimetypes import guess_extension
+from base64 import b64decode
+from functools import partial
 
-from django.utils.six import string_types
-from django.core.files.base import ContentFile
+from six import string_types
+from django.core.files.base import ContentFile, File
+from django.db import transaction
 from django.utils.translation import ugettext_lazy as _
 
-import magic
 from dateutil.parser import parse
 from rest_framework import serializers
 
-from .models import InboundMail, InboundMailHeader, InboundMailDetail, InboundMailAttachment
-from .utils import InboundMailRelationMapper
+from .instrumentation import null_timer
+from .models import (InboundMail, InboundMailHeader, InboundMailDetail, InboundMailAttachment,
+                     lock_content_hashes)
+from .search import get_search_backend
+from .settings import inbound_mail_options as option
+from .utils import (InboundMailRelationMapper, b64encode_file, content_hasher, generate_file_name,
+                    get_extension_resolver, on_rollback, parse_rfc2822_date)
+
+logger = logging.getLogger(__name__)
 
 
 class AutoDateTimeField(serializers.DateTimeField):
     """
-    Attempt to parse incoming datetime value using `dateutil.parser.parse()`
-    function.
+    Attempt to parse incoming datetime value as an RFC 2822 date (the format
+    used by Postmark), then using the `dateutil.parser.parse()` function.
     """
     def to_internal_value(self, value):
+        if isinstance(value, string_types):
+            parsed = parse_rfc2822_date(value)
+            if parsed is not None:
+                return self.enforce_timezone(parsed)
+
         try:
             parsed = parse(value)
         except (ValueError):
@@ -30,10 +45,51 @@ class AutoDateTimeField(serializers.DateTimeField):
         super(AutoDateTimeField, self).to_internal_value(value)
 
 
+def decode_base64_file(data, sniff_extension=True):
+    """
+    Decode a base64 encoded attachment into a `ContentFile` named after its
+    content hash (when attachments are deduplicated) or a random UUID.
+    """
+    decoded_data = b64decode(data)
+
+    hasher = content_hasher()
+    content_hash = None
+    if hasher is not None:
+        hasher.update(decoded_data)
+        content_hash = hasher.hexdigest()
+
+    if sniff_extension:
+        file_name = generate_file_name(decoded_data, content_hash)
+    else:
+        file_name = content_hash or uuid.uuid4().hex
+    content = ContentFile(decoded_data, name=file_name)
+    content.content_hash = content_hash
+    return content
+
+
+def add_attachment_extension(attrs):
+    """
+    Add a file extension to validated attachment content based on the
+    declared content type and name, only sniffing the content when neither
+    is conclusive.
+    """
+    content = attrs['content']
+    if not os.path.splitext(content.name)[1]:
+        resolver = get_extension_resolver()
+        head = content.read(resolver.sniff_bytes)
+        content.seek(0)
+        content.name += resolver.resolve(head, content_type=attrs.get('content_type'), name=attrs.get('name'))
+    return attrs
+
+
 class Base64FileField(serializers.FileField):
     """
     Decode incoming file attachments encoded in Base64 and convert into a
-    Django `ContentFile`.
+    Django `ContentFile`. Attachments already spooled to disk by
+    `PostmarkJSONParser` are passed through as uploaded files.
+
+    Pass `sniff_extension=False` to leave the file extension to the parent
+    serializer, which knows the attachment's declared content type.
     """
     default_error_messages = {
         'decode': _('File could not be decoded.'),
@@ -42,35 +98,116 @@ class Base64FileField(serializers.FileField):
     def __init__(self, *args, **kwargs):
         if 'encode_file' in kwargs:
             self.encode_file = kwargs.pop('encode_file')
+        self.sniff_extension = kwargs.pop('sniff_extension', True)
         super(Base64FileField, self).__init__(*args, **kwargs)
 
     def to_internal_value(self, data):
         # Check to see if it's a base64 encoded file
         if isinstance(data, string_types):
             try:
-                decoded_data = b64decode(data)
+                with self.context.get('timer', null_timer).stage('decode'):
+                    data = decode_base64_file(data, self.sniff_extension)
             except:
                 self.fail('decode')
 
-            file_ext = guess_extension(magic.from_buffer(decoded_data, mime=True).decode('UTF8'), strict=True)
-            file_name = ''.join([uuid.uuid4().hex, file_ext])
-            data = ContentFile(decoded_data, name=file_name)
-
         return super(Base64FileField, self).to_internal_value(data)
 
     def to_representation(self, value):
         encode_file = getattr(self, 'encode_file', False)
 
         if encode_file:
-            return b64encode(value.read()).decode('UTF8')
+            return ''.join(b64encode_file(value))
         else:
             return super(Base64FileField, self).to_representation(value)
 
 
+def attachment_file_name(attachment_data, inbound_mail):
+    """
+    Return the storage name for attachment content. A callable
+    `ATTACHMENT_UPLOAD_TO` is passed an unsaved attachment, as when the file
+    is saved with the model.
+    """
+    field = InboundMailAttachment._meta.get_field('content')
+    attachment = InboundMailAttachment(parent_mail=inbound_mail, **attachment_data)
+    return field.generate_filename(attachment, attachment_data['content'].name)
+
+
+def save_attachment_file(storage, name, content, max_length=None):
+    """
+    Save attachment content to storage, leaving it open and readable for
+    receivers of `inbound_mail_received`. Attachments spooled to a temporary
+    file are copied rather than moved into place.
+    """
+    name = storage.save(name, File(content.file, name=content.name), max_length=max_length)
+    content.seek(0)
+    return name
+
+
+def store_attachment(attachment_data, inbound_mail):
+    """
+    Write attachment content to storage ahead of saving the attachment rows,
+    and return the data of the row, with the stored file name as content.
+    The file is deleted again if the transaction is rolled back.
+    """
+    content = attachment_data['content']
+    if getattr(content, 'content_hash', None):
+        return store_attachment_by_hash(attachment_data, inbound_mail)
+
+    field = InboundMailAttachment._meta.get_field('content')
+    name = attachment_file_name(attachment_data, inbound_mail)
+    name = save_attachment_file(field.storage, name, content, max_length=field.max_length)
+    on_rollback(partial(field.storage.delete, name), using=inbound_mail._state.db)
+    return dict(attachment_data, content=name)
+
+
+def store_attachment_by_hash(attachment_data, inbound_mail):
+    """
+    Point content-addressed attachment data at the stored file with the same
+    content, writing the file to storage only if it doesn't exist yet.
+    Shared files are kept if the transaction is rolled back, to be reused.
+    """
+    content = attachment_data['content']
+    content_hash = content.content_hash
+
+    using = inbound_mail._state.db
+    field = InboundMailAttachment._meta.get_field('content')
+    name = attachment_file_name(attachment_data, inbound_mail)
+    # Held until the mail is committed, so the file isn't deleted meanwhile
+    # by mail with the same attachment being deleted
+    lock_content_hashes([content_hash], using)
+    if not field.storage.exists(name):
+        name = save_attachment_file(field.storage, name, content)
+    transaction.on_commit(partial(restore_attachment_file, field.storage, name, content), using=using)
+    return dict(attachment_data, content=name, content_hash=content_hash)
+
+
+def restore_attachment_file(storage, name, content):
+    """
+    Write a shared attachment file again if it was deleted while the mail
+    referring to it was being saved, which the databases without locks in
+    `lock_content_hashes()` don't prevent. The mail is already committed, so
+    failures are logged rather than raised.
+    """
+    try:
+        if not storage.exists(name):
+            save_attachment_file(storage, name, content)
+    except (IOError, OSError, ValueError):
+        logger.exception('Could not restore shared attachment file %s', name)
+
+
+class InboundMailHeaderListSerializer(serializers.ListSerializer):
+    def get_attribute(self, instance):
+        # Include headers kept in `InboundMail.compact_headers`
+        if isinstance(instance, InboundMail):
+            return instance.get_headers()
+        return super(InboundMailHeaderListSerializer, self).get_attribute(instance)
+
+
 class InboundMailHeaderSerializer(serializers.ModelSerializer):
     class Meta:
         model = InboundMailHeader
         fields = ('name', 'value')
+        list_serializer_class = InboundMailHeaderListSerializer
 
 
 class InboundMailDetailSerializer(serializers.ModelSerializer):
@@ -80,12 +217,15 @@ class InboundMailDetailSerializer(serializers.ModelSerializer):
 
 
 class InboundMailAttachmentSerializer(serializers.ModelSerializer):
-    content = Base64FileField()
+    content = Base64FileField(sniff_extension=False)
 
     class Meta:
         model = InboundMailAttachment
         fields = ('content', 'name', 'content_type', 'content_id', 'content_length')
 
+    def validate(self, attrs):
+        return add_attachment_extension(attrs)
+
 
 class InboundMailSerializer(serializers.ModelSerializer):
     date = AutoDateTimeField()
@@ -102,7 +242,12 @@ class InboundMailSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'date': {'input_formats': ['%a, %d %b %Y %H:%M:%S %z']}
         }
+        # Newer versions of DRF derive a unique together validator from the
+        # message ID constraint. Duplicates are checked before validation
+        # instead (see `processing.is_duplicate_mail`).
+        validators = []
 
+    @transaction.atomic
     def create(self, validated_data):
         header_data = validated_data.pop('headers')
         attachment_data = validated_data.pop('attachments')
@@ -111,12 +256,45 @@ class InboundMailSerializer(serializers.ModelSerializer):
         cc_full_data = validated_data.pop('cc_full')
         bcc_full_data = validated_data.pop('bcc_full')
 
+        # Keep the full header list on the mail itself, saving only the
+        # headers that are queried as rows
+        compact_headers = ''
+        if option.HEADER_STORAGE == 'compact':
+            compact_headers = json.dumps([[header['name'], header['value']] for header in header_data])
+            promoted = set(name.lower() for name in option.PROMOTED_HEADERS)
+            header_data = [header for header in header_data if header['name'].lower() in promoted]
+
+        timer = self.context.get('timer', null_timer)
+
         # Create mail object after data for related entities have been pop'd
-        inbound_mail = InboundMail.objects.create(**validated_data)
+        with timer.stage('db'):
+            inbound_mail = InboundMail.objects.create(
+                attachment_count=len(attachment_data),
+                # Declared sizes, as summed by `count_inbound_mail_attachments`
+                total_attachment_bytes=sum(attachment['content_length'] for attachment in attachment_data),
+                compact_headers=compact_headers,
+                **validated_data)
+
+        # Write attachments to storage before their rows are saved. The
+        # validated data keeps the files, as it's sent with the signal.
+        with timer.stage('storage'):
+            attachment_rows = [store_attachment(attachment, inbound_mail) for attachment in attachment_data]
+
+        with timer.stage('db'):
+            self.create_relations(inbound_mail, attachment_rows, header_data, from_full_data,
+                                  to_full_data, cc_full_data, bcc_full_data)
 
+        return inbound_mail
+
+    def create_relations(self, inbound_mail, attachment_data, header_data, from_full_data,
+                         to_full_data, cc_full_data, bcc_full_data):
         # Create relations with foreign key pointing to inbound_mail parent object
         rel_mapper = InboundMailRelationMapper(parent_mail=inbound_mail)
 
+        # Collect relations and save them with a single INSERT per model
+        if option.BULK_CREATE_RELATIONS:
+            rel_mapper = rel_mapper.bulk()
+
         # Create attachments
         rel_mapper.data(attachment_data).create_for(InboundMailAttachment)
 
@@ -135,4 +313,6 @@ class InboundMailSerializer(serializers.ModelSerializer):
         # Create 'bcc' details
         rel_mapper.data(bcc_full_data).append({'address_type': 'BCC'}).create_for(InboundMailDetail)
 
-        return inbound_mail
+        rel_mapper.bulk_create(batch_size=option.BULK_CREATE_BATCH_SIZE)
+
+        get_search_backend(inbound_mail._state.db).index([inbound_mail])
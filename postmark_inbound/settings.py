@@ -3,7 +3,66 @@ from django.conf import settings
 
 DEFAULTS = {
     'ATTACHMENT_UPLOAD_TO': 'attachments',  # /media/attachments
+    # Name attachment files by a hash of their content and store identical
+    # attachments only once
+    'DEDUPLICATE_ATTACHMENTS': False,
+    # Class used to pick the file extension of attachments
+    'FILE_EXTENSION_RESOLVER': 'postmark_inbound.utils.FileExtensionResolver',
     'SAVE_MAIL_TO_DB': True,
+    # Attachments larger than this (in base64 characters) are decoded to a
+    # temporary file while the request is parsed. Set to None to disable.
+    'ATTACHMENT_SPOOL_THRESHOLD': 2621440,  # 2.5 MB
+    # Save headers, attachments and address details with one INSERT per table
+    'BULK_CREATE_RELATIONS': True,
+    'BULK_CREATE_BATCH_SIZE': None,  # None lets the database backend decide
+    # Write raw payloads to a local spool and process them with the
+    # `process_inbound_spool` management command
+    'SPOOL_INBOUND_MAIL': False,
+    'SPOOL_DIR': None,
+    'SPOOL_BATCH_SIZE': 100,
+    'SPOOL_WORKERS': 4,
+    # Payloads failing this many times (e.g. while the database is down) are
+    # moved to the spool's `failed` directory
+    'SPOOL_MAX_ATTEMPTS': 5,
+    # Ignore mail with a MessageID that has already been received (e.g. when
+    # Postmark retries a webhook). Enforced by a unique database constraint.
+    'UNIQUE_MESSAGE_ID': True,
+    'UNIQUE_MESSAGE_ID_PER_MAILBOX': False,  # Scope uniqueness by mailbox hash
+    'RECENT_MESSAGE_ID_CACHE_SIZE': 1024,
+    # 'sync' sends `inbound_mail_received` during the request. 'deferred' sends
+    # it after the transaction commits, on a pool of SIGNAL_WORKERS threads.
+    'SIGNAL_DISPATCH': 'sync',
+    'SIGNAL_WORKERS': 4,
+    'SIGNAL_RECEIVER_TIMEOUT': 30,  # Seconds, None to disable
+    'SIGNAL_QUEUE_SIZE': 1000,  # Receiver calls queued or running before more are dropped
+    'ASYNC_WORKERS': 4,  # Threads parsing and validating mail for the async webhook
+    # 'rows' stores each header as an `InboundMailHeader`. 'compact' stores the
+    # header list on `InboundMail` and only keeps PROMOTED_HEADERS as rows.
+    'HEADER_STORAGE': 'rows',
+    'PROMOTED_HEADERS': ('X-Spam-Score', 'In-Reply-To', 'References'),
+    # Bodies of at least this many characters are stored compressed. Set to
+    # None to store new bodies uncompressed.
+    'BODY_COMPRESSION_THRESHOLD': 1024,
+    # Don't load bodies unless `InboundMail.objects.with_bodies()` is used
+    'DEFER_MAIL_BODIES': True,
+    # Limits applied by the `purge_inbound_mail` management command
+    'RETENTION_DAYS': None,
+    'RETENTION_MAX_COUNT': None,
+    'PURGE_BATCH_SIZE': 500,
+    'PURGE_BATCH_DELAY': 0.1,  # Seconds between batches
+    'EXPORT_BATCH_SIZE': 200,  # Mails loaded per query when exporting
+    # Monthly partitions of the mail table created ahead of time by the
+    # `partition_inbound_mail` management command (PostgreSQL only)
+    'PARTITION_MONTHS_AHEAD': 3,
+    # Index subject, sender and bodies with SQLite FTS5 or PostgreSQL tsvector
+    'FULL_TEXT_SEARCH': True,
+    'SEARCH_CONFIG': 'english',  # PostgreSQL text search configuration
+    # Validate payloads against a schema compiled from the models, falling back
+    # to `InboundMailSerializer` for anything it doesn't accept
+    'FAST_VALIDATION': False,
+    # Time each stage of webhook requests (see `inbound_mail_timed` signal)
+    'INSTRUMENTATION': True,
+    'LOG_TIMINGS': False,  # Log timings at INFO level to `postmark_inbound.instrumentation`
     'IP_WHITE_LIST': [
         '50.31.156.104',
         '50.31.156.105',
@@ -11,7 +70,15 @@ DEFAULTS = {
         '50.31.156.107',
         '50.31.156.108',
         '50.31.156.6',
-        '127.0.0.1']
+        '127.0.0.1'],  # Addresses or CIDR ranges, IPv4 or IPv6
+    # Number of proxies in front of the app that append to X-Forwarded-For.
+    # The client address is taken from that many entries from the right,
+    # only for requests from `TRUSTED_PROXIES` if they are set.
+    'TRUSTED_PROXY_DEPTH': 0,
+    # Use the X-Real-IP header, but only from `TRUSTED_PROXIES` addresses or
+    # CIDR ranges, as clients can send the header themselves
+    'TRUST_X_REAL_IP': False,
+    'TRUSTED_PROXIES': [],
 }
 
 
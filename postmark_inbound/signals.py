@@ -2,3 +2,8 @@ import django.dispatch
 
 inbound_mail_received = django.dispatch.Signal(providing_args=["mail_data",
                                                                "mail_object"])
+
+# Sent after each webhook request when the `INSTRUMENTATION` option is enabled,
+# with the `RequestTimer.as_dict()` measurements
+inbound_mail_timed = django.dispatch.Signal(providing_args=["timings",
+                                                            "mail_object"])
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import inbound_mail_options as option
+
+# Payload names, with the number of failed attempts once a payload is retried
+payload_name_re = re.compile(r'^(?P<base>.+?)(?:\.(?P<attempts>\d+))?\.json$')
+
+
+class InboundMailSpool(object):
+    """
+    A durable, append-only spool of raw Postmark payloads kept in a local
+    directory. Each payload is stored as its own file and moves between the
+    following sub-directories as it is processed:
+
+        tmp/         payloads that are still being written
+        incoming/    payloads waiting to be processed
+        processing/  payloads claimed by a worker
+        failed/      payloads that could not be processed
+
+    Moving files with `os.rename()` is atomic, so a payload is only ever
+    claimed by a single worker. The number of failed attempts to process a
+    payload is kept in its name.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_dir = os.path.join(path, 'tmp')
+        self.incoming_dir = os.path.join(path, 'incoming')
+        self.processing_dir = os.path.join(path, 'processing')
+        self.failed_dir = os.path.join(path, 'failed')
+        for directory in (self.tmp_dir, self.incoming_dir,
+                          self.processing_dir, self.failed_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _fsync_dir(self, directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, payload):
+        """
+        Durably write a raw payload (bytes) to the spool and return its name.
+        """
+        # Names sort in order of arrival
+        name = '%016d-%s.json' % (int(time.time() * 1000000), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, os.path.join(self.incoming_dir, name))
+        self._fsync_dir(self.incoming_dir)
+        return name
+
+    def claim(self, limit, exclude=()):
+        """
+        Claim up to `limit` of the oldest payloads for processing, other than
+        those named in `exclude`, and return their names.
+        """
+        claimed = []
+        for name in sorted(os.listdir(self.incoming_dir)):
+            if len(claimed) >= limit:
+                break
+            if name in exclude:
+                continue
+            try:
+                os.rename(os.path.join(self.incoming_dir, name),
+                          os.path.join(self.processing_dir, name))
+            except OSError:
+                # Claimed by another worker
+                continue
+            claimed.append(name)
+        return claimed
+
+    def read(self, name):
+        with open(os.path.join(self.processing_dir, name), 'rb') as f:
+            return f.read()
+
+    def complete(self, name):
+        os.remove(os.path.join(self.processing_dir, name))
+
+    def fail(self, name):
+        os.rename(os.path.join(self.processing_dir, name),
+                  os.path.join(self.failed_dir, name))
+
+    @staticmethod
+    def attempts(name):
+        """
+        Return the number of failed attempts to process a payload.
+        """
+        match = payload_name_re.match(name)
+        return int(match.group('attempts') or 0) if match else 0
+
+    def release(self, name, max_attempts=None):
+        """
+        Return a claimed payload that failed to be processed to the spool, so
+        it is retried later. Once it has failed `max_attempts` times it is
+        moved to `failed/` instead.
+
+        Returns the new name of the payload, or None if it was failed.
+        """
+        attempts = self.attempts(name) + 1
+        if max_attempts is not None and attempts >= max_attempts:
+            self.fail(name)
+            return None
+        new_name = '%s.%d.json' % (payload_name_re.match(name).group('base'), attempts)
+        os.rename(os.path.join(self.processing_dir, name),
+                  os.path.join(self.incoming_dir, new_name))
+        return new_name
+
+    def recover(self):
+        """
+        Return payloads left in `processing/` by a worker that exited early to
+        the spool, without counting an attempt. Returns the number of payloads
+        recovered.
+        """
+        names = os.listdir(self.processing_dir)
+        for name in names:
+            os.rename(os.path.join(self.processing_dir, name),
+                      os.path.join(self.incoming_dir, name))
+        return len(names)
+
+    def __len__(self):
+        return len(os.listdir(self.incoming_dir))
+
+
+def get_spool():
+    if not option.SPOOL_DIR:
+        raise ImproperlyConfigured(
+            "The 'SPOOL_DIR' option must be set to spool inbound mail.")
+    return InboundMailSpool(option.SPOOL_DIR)
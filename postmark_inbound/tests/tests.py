@@ -1,19 +1,55 @@
-from base64 import b64encode
+from base64 import b64decode, b64encode
 import os
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 import datetime
 import json
+import shutil
+import tempfile
+import threading
+import time
+from unittest import skipUnless
 
-from django.test import TestCase
+import django
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connection, transaction
+from django.core.management import CommandError, call_command
+from django.dispatch import Signal
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.core.files.base import ContentFile
-from django.utils.six import text_type, BytesIO
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from six import text_type, BytesIO, StringIO
 from django.utils import timezone
 
+from django.forms.models import inlineformset_factory
+
+from dateutil.parser import parse
 from rest_framework import serializers
 
-from .. models import InboundMailAttachment, InboundMailHeader
+from .. models import InboundMail, InboundMailAttachment, InboundMailHeader
 from ..serializers import Base64FileField, AutoDateTimeField, InboundMailSerializer
-from ..parsers import PostmarkJSONParser
+from ..parsers import PostmarkJSONParser, underscoreize
+from ..settings import inbound_mail_options
+from ..admin import InboundMailAdmin, LimitedInlineFormSet
+from ..benchmark import compare_results, run_benchmark
+from ..fields import COMPRESSED_PREFIX, CompressedText
+from ..dispatch import DeferredSignalDispatcher, get_dispatcher
+from ..partitioning import (add_months, convert_statements, create_partition_statements, partition_month,
+                            partition_name, partitions_before)
+from ..processing import process_inbound_mail, recent_message_ids
+from ..retention import delete_mail
+from ..routing import InboundMailRouter, router
+from ..search import get_search_backend
+from ..signals import inbound_mail_received, inbound_mail_timed
+from ..spool import InboundMailSpool
+from ..utils import FileExtensionResolver, IPAllowList, b64decode_to_file, b64encode_file, parse_rfc2822_date
+from ..validation import FastInboundMailSerializer, inbound_mail_validator
+from ..views import PostmarkPermission
 
 
 class TestBase64FileField(TestCase):
@@ -37,6 +73,71 @@ class TestBase64FileField(TestCase):
         self.assertEqual(base64_string, self.encoded_contents)
 
 
+class TestFileExtensionResolver(TestCase):
+    def setUp(self):
+        self.resolver = FileExtensionResolver()
+
+    def test_declared_content_type_is_preferred(self):
+        with mock.patch.object(self.resolver, 'from_content') as from_content:
+            self.assertEqual(self.resolver.resolve(b'%PDF', 'text/plain; charset=utf-8', 'a.pdf'), '.txt')
+        self.assertFalse(from_content.called)
+
+    def test_file_name_is_used_for_generic_content_type(self):
+        self.assertEqual(self.resolver.resolve(b'', 'application/octet-stream', 'report.PDF'), '.pdf')
+
+    def test_content_is_sniffed_as_last_resort(self):
+        self.assertEqual(self.resolver.resolve(b'%PDF-1.4\n' + b'x' * 10000, None, 'noextension'), '.pdf')
+
+
+class TestPostmarkPermission(TestCase):
+    def setUp(self):
+        self.permission = PostmarkPermission()
+        self.permission.postmark_inbound_ip = IPAllowList(['50.31.156.0/28', '10.0.0.1', '2001:db8::/32'])
+
+    def request(self, **meta):
+        return mock.Mock(META=meta)
+
+    def test_allow_list_matches_ranges(self):
+        allow_list = self.permission.postmark_inbound_ip
+        self.assertTrue('50.31.156.15' in allow_list)
+        self.assertFalse('50.31.156.16' in allow_list)
+        self.assertTrue('10.0.0.1' in allow_list)
+        self.assertTrue('2001:db8::1' in allow_list)
+        self.assertTrue('::ffff:10.0.0.1' in allow_list)
+        self.assertFalse('not an address' in allow_list)
+
+    def test_remote_addr(self):
+        self.assertTrue(self.permission.has_permission(self.request(REMOTE_ADDR='10.0.0.1'), None))
+        self.assertFalse(self.permission.has_permission(self.request(REMOTE_ADDR='10.0.0.2'), None))
+
+    def test_trusted_proxy_depth(self):
+        request = self.request(REMOTE_ADDR='192.168.0.1',
+                               HTTP_X_FORWARDED_FOR='10.0.0.2, 50.31.156.1, 192.168.0.2')
+        with mock.patch.object(inbound_mail_options, 'TRUSTED_PROXY_DEPTH', 2):
+            self.assertTrue(self.permission.has_permission(request, None))
+        with mock.patch.object(inbound_mail_options, 'TRUSTED_PROXY_DEPTH', 3):
+            # The leftmost entry can be forged by the client
+            self.assertFalse(self.permission.has_permission(request, None))
+
+    def test_trusted_proxy_depth_requires_trusted_proxy(self):
+        self.permission.trusted_proxies = IPAllowList(['192.168.0.0/24'])
+        forged = self.request(REMOTE_ADDR='203.0.113.1', HTTP_X_FORWARDED_FOR='50.31.156.1, 192.168.0.2')
+        proxied = self.request(REMOTE_ADDR='192.168.0.1', HTTP_X_FORWARDED_FOR='50.31.156.1, 192.168.0.2')
+        with mock.patch.object(inbound_mail_options, 'TRUSTED_PROXY_DEPTH', 2):
+            self.assertEqual(self.permission.get_client_ip(forged), '203.0.113.1')
+            self.assertFalse(self.permission.has_permission(forged, None))
+            self.assertTrue(self.permission.has_permission(proxied, None))
+
+    def test_x_real_ip(self):
+        request = self.request(REMOTE_ADDR='192.168.0.1', HTTP_X_REAL_IP='10.0.0.1')
+        # Ignored by default, as clients can send it
+        self.assertFalse(self.permission.has_permission(request, None))
+        with mock.patch.object(inbound_mail_options, 'TRUST_X_REAL_IP', True):
+            self.assertFalse(self.permission.has_permission(request, None))
+            self.permission.trusted_proxies = IPAllowList(['192.168.0.0/24'])
+            self.assertTrue(self.permission.has_permission(request, None))
+
+
 class TestAutoDateTimeField(TestCase):
     valid_inputs = {
         'Fri, 1 Aug 2014 16:45:32 -0400': datetime.datetime(2014, 8, 1, 20, 45, 32, tzinfo=timezone.UTC()),
@@ -59,6 +160,53 @@ class TestAutoDateTimeField(TestCase):
             with self.assertRaises(serializers.ValidationError):
                 self.field.run_validation(input_value)
 
+    def test_rfc2822_dates_match_dateutil(self):
+        for value in ('Fri, 1 Aug 2014 16:45:32 -0400', 'Fri, 01 Aug 2014 16:45:32 -04:00',
+                      '1 Aug 2014 16:45 +0530', 'fri, 1 aug 2014 16:45:32 -0000'):
+            self.assertEqual(parse_rfc2822_date(value), parse(value))
+        for value in ('Fri, 1 Aug 2014 16:45:32 EDT', '2001-01-01 13:00', 'Fri, 31 Feb 2014 16:45:32 -0400'):
+            self.assertIsNone(parse_rfc2822_date(value))
+
+
+class TestPostmarkJSONParser(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.example_json = open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read()
+
+    def test_parser_matches_underscoreize(self):
+        stream = BytesIO(self.example_json.encode())
+        data = PostmarkJSONParser().parse(stream)
+        self.assertEqual(data, underscoreize(json.loads(self.example_json)))
+
+    def test_parser_translates_unknown_keys(self):
+        stream = BytesIO(b'{"SomeNewField": {"NestedKey": 1}, "Cc": ""}')
+        data = PostmarkJSONParser().parse(stream)
+        self.assertEqual(data, {'some_new_field': {'nested_key': 1}, 'cc_email': ''})
+
+    def test_parser_spools_large_attachments(self):
+        json_data = json.loads(self.example_json)
+        stream = BytesIO(self.example_json.encode())
+        with mock.patch.object(inbound_mail_options, 'ATTACHMENT_SPOOL_THRESHOLD', 0):
+            data = PostmarkJSONParser().parse(stream)
+        for source, attachment in zip(json_data['Attachments'], data['attachments']):
+            content = attachment['content']
+            self.assertTrue(isinstance(content, TemporaryUploadedFile))
+            self.assertEqual(b64encode(content.read()).decode('UTF-8'), source['Content'])
+
+        serializer = InboundMailSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        inbound_mail = serializer.save()
+        self.assertEqual(inbound_mail.attachments.count(), 2)
+
+    def test_chunked_base64_decoding(self):
+        contents = os.urandom(1000)
+        encoded = b64encode(contents).decode('UTF-8')
+        # Line breaks must not throw the chunks out of alignment
+        encoded = '\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+        output = BytesIO()
+        b64decode_to_file(encoded, output, chunk_size=100)
+        self.assertEqual(output.getvalue(), contents)
+
 
 class TestInboundMailSerializer(TestCase):
     def setUp(self):
@@ -123,3 +271,814 @@ class TestInboundMailSerializer(TestCase):
                 header.__class__,
                 InboundMailHeader.__class__))
         self.assertTrue(count_headers > 0)
+
+    def test_serializer_stores_attachment_stats(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        inbound_mail = InboundMail.objects.get(pk=inbound_mail.pk)
+        self.assertEqual(inbound_mail.attachment_count, 2)
+        self.assertEqual(inbound_mail.total_attachment_bytes, 90)
+        with self.assertNumQueries(0):
+            self.assertTrue(inbound_mail.has_attachment())
+
+    def test_validated_attachments_stay_readable(self):
+        # Receivers of `inbound_mail_received` are sent the validated data
+        self.serializer.is_valid(raise_exception=True)
+        self.serializer.save()
+        content = self.serializer.validated_data['attachments'][0]['content']
+        self.assertEqual(content.read(), b'This is attachment contents, base-64 encoded.')
+
+    def test_callable_upload_to_is_passed_the_attachment(self):
+        field = InboundMailAttachment._meta.get_field('content')
+        upload_to = lambda instance, filename: 'mail/%s/%s' % (instance.parent_mail.pk, filename)
+        self.serializer.is_valid(raise_exception=True)
+        with mock.patch.object(field, 'upload_to', upload_to):
+            inbound_mail = self.serializer.save()
+        for attachment in inbound_mail.attachments.all():
+            self.assertTrue(attachment.content.name.startswith('mail/%s/' % inbound_mail.pk))
+
+    def test_attachment_files_are_deleted_on_rollback(self):
+        storage = InboundMailAttachment._meta.get_field('content').storage
+        save, saved = storage.save, []
+
+        def record_save(*args, **kwargs):
+            saved.append(save(*args, **kwargs))
+            return saved[-1]
+        self.serializer.is_valid(raise_exception=True)
+        with mock.patch.object(storage, 'save', record_save), \
+                mock.patch.object(InboundMailSerializer, 'create_relations', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.serializer.save()
+        self.assertEqual(len(saved), 2)
+        self.assertFalse(any(storage.exists(name) for name in saved))
+
+    def test_count_attachments_of_existing_mail(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        # Simulate mail saved before attachment stats were stored
+        InboundMail.objects.update(attachment_count=None, total_attachment_bytes=None)
+        inbound_mail = InboundMail.objects.get(pk=inbound_mail.pk)
+        self.assertTrue(inbound_mail.has_attachment())
+
+        call_command('count_inbound_mail_attachments', stdout=StringIO())
+        inbound_mail = InboundMail.objects.get(pk=inbound_mail.pk)
+        self.assertEqual(inbound_mail.attachment_count, 2)
+        self.assertEqual(inbound_mail.total_attachment_bytes, 90)
+
+    def test_attachment_stats_match_backfill(self):
+        self.serializer.initial_data['attachments'][0]['content_length'] = 1000
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        stored = InboundMail.objects.values_list('total_attachment_bytes', flat=True).get(pk=inbound_mail.pk)
+        InboundMail.objects.update(attachment_count=None, total_attachment_bytes=None)
+        call_command('count_inbound_mail_attachments', stdout=StringIO())
+        self.assertEqual(InboundMail.objects.values_list('total_attachment_bytes', flat=True).get(), stored)
+
+    def test_with_details_serializes_in_constant_queries(self):
+        self.serializer.is_valid(raise_exception=True)
+        self.serializer.save()
+        # Mail, address details, headers and attachments
+        with self.assertNumQueries(4):
+            mails = InboundMail.objects.with_bodies().with_details()
+            data = InboundMailSerializer(mails, many=True).data
+        self.assertEqual(data[0]['from_full']['email'], 'support@postmarkapp.com')
+        self.assertEqual(len(data[0]['cc_full']), 2)
+        self.assertEqual(len(data[0]['headers']), 4)
+
+    def test_bodies_are_deferred_by_default(self):
+        self.serializer.is_valid(raise_exception=True)
+        self.serializer.save()
+        inbound_mail = InboundMail.objects.get()
+        self.assertEqual(inbound_mail.get_deferred_fields(), {'text_body', 'html_body', 'stripped_text_reply'})
+        with self.assertNumQueries(1):
+            self.assertEqual(inbound_mail.text_body, 'This is a test text body.')
+        inbound_mail = InboundMail.objects.with_bodies().get()
+        self.assertEqual(inbound_mail.get_deferred_fields(), set())
+        # Fields deferred by the caller stay deferred
+        inbound_mail = InboundMail.objects.defer('subject').with_bodies().get()
+        self.assertEqual(inbound_mail.get_deferred_fields(), {'subject'})
+        inbound_mail = InboundMail.objects.only('subject').with_bodies().get()
+        self.assertIn('tag', inbound_mail.get_deferred_fields())
+        self.assertNotIn('text_body', inbound_mail.get_deferred_fields())
+
+    def test_compact_header_storage(self):
+        self.serializer.is_valid(raise_exception=True)
+        with mock.patch.object(inbound_mail_options, 'HEADER_STORAGE', 'compact'):
+            inbound_mail = self.serializer.save()
+        # Only promoted headers are stored as rows
+        self.assertEqual(list(inbound_mail.headers.values_list('name', flat=True)), ['X-Spam-Score'])
+        headers = InboundMailSerializer(inbound_mail).data['headers']
+        self.assertEqual(headers, self.serializer.initial_data['headers'])
+
+    def test_bodies_are_stored_compressed(self):
+        html_body = '<html><body>%s</body></html>' % ('<p>Compressible</p>' * 200)
+        self.serializer.initial_data['html_body'] = html_body
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+
+        stored = InboundMail.objects.values_list('html_body', 'text_body').get(pk=inbound_mail.pk)
+        self.assertTrue(isinstance(stored[0], CompressedText))
+        self.assertTrue(len(stored[0]) < len(html_body))
+        self.assertEqual(stored[1], 'This is a test text body.')
+        self.assertEqual(InboundMail.objects.get(pk=inbound_mail.pk).html_body, html_body)
+
+    def test_body_starting_with_compressed_prefix(self):
+        text_body = COMPRESSED_PREFIX + 'not compressed'
+        self.serializer.initial_data['text_body'] = text_body
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        self.assertEqual(InboundMail.objects.with_bodies().get(pk=inbound_mail.pk).text_body, text_body)
+        # Stored as plain text before such values were compressed
+        with mock.patch.object(inbound_mail_options, 'BODY_COMPRESSION_THRESHOLD', None):
+            InboundMail.objects.filter(pk=inbound_mail.pk).update(text_body=CompressedText(text_body))
+        self.assertEqual(InboundMail.objects.with_bodies().get(pk=inbound_mail.pk).text_body, text_body)
+
+    def test_compress_existing_bodies(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        html_body = '<p>Compressible</p>' * 200
+        # Simulate a body saved before compression was enabled
+        with mock.patch.object(inbound_mail_options, 'BODY_COMPRESSION_THRESHOLD', None):
+            InboundMail.objects.filter(pk=inbound_mail.pk).update(html_body=html_body)
+        call_command('compress_inbound_mail_bodies', stdout=StringIO())
+        stored = InboundMail.objects.values_list('html_body', flat=True).get(pk=inbound_mail.pk)
+        self.assertTrue(isinstance(stored, CompressedText))
+        self.assertEqual(InboundMail.objects.get(pk=inbound_mail.pk).html_body, html_body)
+
+    def test_full_text_search(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        self.assertEqual(list(InboundMail.objects.search('reply text')), [inbound_mail])
+        self.assertEqual(list(InboundMail.objects.search('support@postmarkapp.com')), [inbound_mail])
+        self.assertEqual(list(InboundMail.objects.search('"missing')), [])
+        inbound_mail.delete()
+        self.assertEqual(list(InboundMail.objects.search('reply')), [])
+
+    def test_rebuild_search_index(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        get_search_backend().remove([inbound_mail.pk])
+        self.assertEqual(list(InboundMail.objects.search('reply')), [])
+        # Bodies are loaded with the batch, not one mail at a time
+        with mock.patch.object(InboundMail, 'refresh_from_db', side_effect=AssertionError):
+            call_command('rebuild_inbound_search_index', stdout=StringIO())
+        self.assertEqual(list(InboundMail.objects.search('reply')), [inbound_mail])
+
+    def test_admin_inline_formset_is_limited(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        FormSet = inlineformset_factory(InboundMail, InboundMailHeader, formset=LimitedInlineFormSet,
+                                        fields=('name', 'value'), extra=0)
+        FormSet.max_rows = 2
+        formset = FormSet(instance=inbound_mail)
+        self.assertEqual(inbound_mail.headers.count(), 4)
+        self.assertEqual(len(formset.forms), 2)
+
+    def test_admin_shows_all_headers_only_when_compact(self):
+        self.serializer.is_valid(raise_exception=True)
+        inbound_mail = self.serializer.save()
+        model_admin = InboundMailAdmin(InboundMail, admin.site)
+
+        def get_field_names(obj):
+            return [name for title, options in model_admin.get_fieldsets(None, obj) for name in options['fields']]
+        self.assertNotIn('all_headers', get_field_names(inbound_mail))
+        inbound_mail.compact_headers = '[["X-Spam-Score", "0"]]'
+        self.assertIn('all_headers', get_field_names(inbound_mail))
+
+    def test_serializer_bulk_creates_relations(self):
+        self.serializer.is_valid(raise_exception=True)
+        with CaptureQueriesContext(connection) as context:
+            inbound_mail = self.serializer.save()
+        # Mail, attachments, headers and address details: one INSERT each
+        inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 4)
+        self.assertEqual(inbound_mail.attachments.count(), 2)
+        self.assertEqual(inbound_mail.address_details.filter(address_type='CC').count(), 2)
+        self.assertEqual(inbound_mail.from_full.email, 'support@postmarkapp.com')
+
+    def test_serializer_creates_relations_individually(self):
+        self.serializer.is_valid(raise_exception=True)
+        with mock.patch.object(inbound_mail_options, 'BULK_CREATE_RELATIONS', False):
+            inbound_mail = self.serializer.save()
+        self.assertEqual(inbound_mail.attachments.count(), 2)
+        self.assertEqual(inbound_mail.address_details.count(), 6)
+
+
+class TestDuplicateInboundMail(TransactionTestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.example_json = open(os.path.join(BASE_DIR, 'example_0_attachments.json')).read()
+        recent_message_ids.clear()
+        self.receiver = mock.Mock()
+        inbound_mail_received.connect(self.receiver)
+        self.addCleanup(inbound_mail_received.disconnect, self.receiver)
+
+    def process(self):
+        data = PostmarkJSONParser().parse(BytesIO(self.example_json.encode()))
+        return process_inbound_mail(data, sender=None)
+
+    def test_duplicate_mail_is_ignored(self):
+        self.assertIsNotNone(self.process())
+        self.assertIsNone(self.process())
+        self.assertEqual(InboundMail.objects.count(), 1)
+        self.assertEqual(self.receiver.call_count, 1)
+
+    def test_duplicate_check_uses_recent_message_ids(self):
+        self.process()
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.process())
+
+    def test_duplicate_check_falls_back_to_database(self):
+        self.process()
+        recent_message_ids.clear()
+        with self.assertNumQueries(1):
+            self.assertIsNone(self.process())
+
+    def test_mail_without_message_id(self):
+        self.example_json = self.example_json.replace('"MessageID"', '"IgnoredMessageID"')
+        self.assertIsNotNone(self.process())
+        self.assertIsNotNone(self.process())
+        self.assertEqual(InboundMail.objects.count(), 2)
+
+    def test_message_id_uniqueness_per_mailbox(self):
+        self.process()
+        self.example_json = self.example_json.replace('"MailboxHash": "SampleHash"', '"MailboxHash": "OtherHash"')
+        recent_message_ids.clear()
+        self.assertIsNone(self.process())
+        with mock.patch.object(inbound_mail_options, 'UNIQUE_MESSAGE_ID_PER_MAILBOX', True):
+            self.assertIsNotNone(self.process())
+            self.assertIsNone(self.process())
+        self.assertEqual(InboundMail.objects.count(), 2)
+
+    def test_same_mailbox_duplicates_rejected_by_database(self):
+        self.process()
+        with mock.patch.object(inbound_mail_options, 'UNIQUE_MESSAGE_ID', False):
+            self.assertIsNone(self.process())
+        self.assertEqual(InboundMail.objects.count(), 1)
+
+    def test_migrations_are_up_to_date(self):
+        call_command('makemigrations', 'postmark_inbound', check=True, dry_run=True, stdout=StringIO())
+
+    def test_rolled_back_mail_is_not_remembered(self):
+        try:
+            with transaction.atomic():
+                self.process()
+                raise DatabaseError()
+        except DatabaseError:
+            pass
+        self.assertIsNotNone(self.process())
+
+
+class TestFastValidation(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.examples = [open(os.path.join(BASE_DIR, name)).read() for name in
+                         ('example_0_attachments.json', 'example_2_attachments.json')]
+
+    def parse(self, example):
+        return PostmarkJSONParser().parse(BytesIO(example.encode()))
+
+    def normalize(self, validated_data):
+        # File names are random, so compare attachments by extension and content
+        def encode(value):
+            if hasattr(value, 'read'):
+                return [os.path.splitext(value.name)[1], b64encode(value.read()).decode()]
+            return value.isoformat()
+        return json.loads(json.dumps(validated_data, default=encode))
+
+    def test_same_validated_data_as_serializer(self):
+        for example in self.examples:
+            serializer = InboundMailSerializer(data=self.parse(example))
+            serializer.is_valid(raise_exception=True)
+
+            validated_data = inbound_mail_validator.validate(self.parse(example))
+            self.assertIsNotNone(validated_data)
+            self.assertEqual(list(validated_data), list(serializer.validated_data))
+            self.assertEqual(self.normalize(validated_data), self.normalize(serializer.validated_data))
+
+    def test_invalid_data_falls_back_to_serializer(self):
+        for changes in ({'from_email': 'not an email'}, {'date': 'abc'}, {'subject': 1},
+                        {'to_full': {}}, {'headers': [{'value': 'No name'}]}):
+            data = self.parse(self.examples[1])
+            data.update(changes)
+            self.assertIsNone(inbound_mail_validator.validate(data))
+
+            data = self.parse(self.examples[1])
+            data.update(changes)
+            serializer = InboundMailSerializer(data=data)
+            fast_serializer = FastInboundMailSerializer(data=data)
+            self.assertEqual(serializer.is_valid(), fast_serializer.is_valid())
+            self.assertEqual(serializer.errors, fast_serializer.errors)
+
+    def test_fast_serializer_saves_mail(self):
+        serializer = FastInboundMailSerializer(data=self.parse(self.examples[1]))
+        serializer.is_valid(raise_exception=True)
+        inbound_mail = serializer.save()
+        self.assertEqual(inbound_mail.attachments.count(), 2)
+        self.assertEqual(inbound_mail.headers.count(), len(self.parse(self.examples[1])['headers']))
+
+
+class TestInstrumentation(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.example_json = open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read()
+        recent_message_ids.clear()
+        self.receiver = mock.Mock()
+        inbound_mail_timed.connect(self.receiver)
+        self.addCleanup(inbound_mail_timed.disconnect, self.receiver)
+
+    def test_webhook_reports_stage_timings(self):
+        with self.assertLogs('postmark_inbound.instrumentation', level='INFO'), \
+                mock.patch.object(inbound_mail_options, 'LOG_TIMINGS', True):
+            response = self.client.post('/inbound', self.example_json,
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('validate;dur=', response['Server-Timing'])
+
+        timings = self.receiver.call_args[1]['timings']
+        self.assertEqual(self.receiver.call_args[1]['mail_object'], InboundMail.objects.get())
+        for stage in ('parse', 'validate', 'decode', 'db', 'storage', 'signal'):
+            self.assertIn(stage, timings['stages'])
+        self.assertEqual(timings['attachment_count'], 2)
+        self.assertEqual(timings['payload_bytes'], len(self.example_json.encode()))
+        self.assertTrue(timings['queries'] > 0)
+
+    def test_instrumentation_can_be_disabled(self):
+        with mock.patch.object(inbound_mail_options, 'INSTRUMENTATION', False):
+            response = self.client.post('/inbound', self.example_json,
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertFalse(self.receiver.called)
+
+
+@skipUnless(django.VERSION >= (3, 1), 'Async views require Django 3.1 or later')
+@override_settings(ROOT_URLCONF='postmark_inbound.async_urls')
+class TestAsyncInboundMailWebhook(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.example_json = open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read()
+        recent_message_ids.clear()
+
+    async def test_webhook_saves_mail_and_awaits_receivers(self):
+        received = []
+
+        async def receiver(sender, mail_object, **kwargs):
+            received.append(mail_object)
+        inbound_mail_received.connect(receiver)
+        self.addCleanup(inbound_mail_received.disconnect, receiver)
+
+        response = await self.async_client.post('/inbound', self.example_json,
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('validate;dur=', response['Server-Timing'])
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].attachment_count, 2)
+
+    async def test_invalid_payload_returns_errors(self):
+        response = await self.async_client.post('/inbound', '{"Subject": "Missing fields"}',
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('from_email', response.json())
+
+    async def test_get_is_not_allowed(self):
+        response = await self.async_client.get('/inbound')
+        self.assertEqual(response.status_code, 405)
+
+
+class TestInboundMailRouter(TestCase):
+    def setUp(self):
+        self.router = InboundMailRouter()
+        self.tenant = mock.Mock()
+        self.support = mock.Mock()
+        self.tagged_support = mock.Mock()
+        self.fallback = mock.Mock()
+        self.router.route(mailbox_hash='tenant-1')(self.tenant)
+        self.router.route(to='Support@example.com')(self.support)
+        self.router.route(to='support@example.com', tag='urgent')(self.tagged_support)
+        self.router.route()(self.fallback)
+
+    def test_dispatch_calls_matching_handlers(self):
+        self.router.dispatch(None, {'mailbox_hash': 'tenant-1', 'to_email': 'Help <SUPPORT@example.com>'})
+        self.assertTrue(self.tenant.called)
+        self.assertTrue(self.support.called)
+        self.assertFalse(self.tagged_support.called)
+        self.assertFalse(self.fallback.called)
+
+        self.router.dispatch(None, {'original_recipient': 'support@example.com', 'tag': 'urgent'})
+        self.assertTrue(self.tagged_support.called)
+        self.assertEqual(self.tenant.call_count, 1)
+
+    def test_route_on_full_recipient_lists(self):
+        self.router.dispatch(None, {'to_email': '"Support, Sales" <sales@example.com>',
+                                    'to_full': [{'email': 'sales@example.com', 'name': 'Support, Sales'}],
+                                    'cc_full': [], 'bcc_full': [{'email': 'Support@Example.com', 'name': ''}]})
+        self.assertTrue(self.support.called)
+        self.assertFalse(self.fallback.called)
+
+    def test_unmatched_mail_goes_to_catch_all(self):
+        self.router.dispatch(None, {'mailbox_hash': 'tenant-2', 'to_email': 'sales@example.com'})
+        self.assertTrue(self.fallback.called)
+        self.assertFalse(self.tenant.called)
+
+    def test_stats_count_calls_and_failures(self):
+        self.tenant.side_effect = ValueError
+        with self.assertLogs('postmark_inbound.routing', level='ERROR'):
+            self.router.dispatch(None, {'mailbox_hash': 'tenant-1'})
+        stats = self.router.stats()
+        self.assertEqual(stats['mailbox_hash=tenant-1'], {'calls': 1, 'failures': 1})
+        self.assertEqual(stats['to=support@example.com,tag=urgent'], {'calls': 0, 'failures': 0})
+
+    def test_router_receives_inbound_mail_signal(self):
+        handler = mock.Mock()
+        router.route(tag='routed')(handler)
+        self.addCleanup(router.disconnect, handler)
+        inbound_mail_received.send(sender=None, mail_data={'tag': 'routed'}, mail_object=None)
+        self.assertTrue(handler.called)
+
+
+class TestDeferredSignalDispatcher(TransactionTestCase):
+    def setUp(self):
+        recent_message_ids.clear()
+
+    def test_receivers_run_after_commit_in_worker_thread(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        example_json = open(os.path.join(BASE_DIR, 'example_0_attachments.json')).read()
+        calls = []
+
+        def receiver(sender, **kwargs):
+            calls.append((threading.current_thread(), kwargs['mail_object']))
+        inbound_mail_received.connect(receiver)
+        self.addCleanup(inbound_mail_received.disconnect, receiver)
+
+        data = PostmarkJSONParser().parse(BytesIO(example_json.encode()))
+        with mock.patch.object(inbound_mail_options, 'SIGNAL_DISPATCH', 'deferred'):
+            mail_object = process_inbound_mail(data, sender=None)
+        get_dispatcher(inbound_mail_received).join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertNotEqual(calls[0][0], threading.current_thread())
+        self.assertEqual(calls[0][1], mail_object)
+
+    def test_receiver_failures_and_timeouts_are_recorded(self):
+        signal = Signal(providing_args=['mail_data', 'mail_object'])
+        dispatcher = DeferredSignalDispatcher(signal, max_workers=2, timeout=0)
+
+        def failing_receiver(sender, **kwargs):
+            raise ValueError
+        signal.connect(failing_receiver)
+
+        with self.assertLogs('postmark_inbound', level='WARNING'):
+            dispatcher.send(sender=None, mail_data={}, mail_object=None)
+            dispatcher.join(5)
+        stats = list(dispatcher.stats().values())[0]
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['failures'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+
+    def test_hung_receiver_is_reported_and_queue_is_bounded(self):
+        signal = Signal(providing_args=['mail_data', 'mail_object'])
+        dispatcher = DeferredSignalDispatcher(signal, max_workers=1, timeout=0.01, max_pending=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def hung_receiver(sender, **kwargs):
+            release.wait(5)
+        signal.connect(hung_receiver)
+
+        with self.assertLogs('postmark_inbound', level='WARNING') as logs:
+            for i in range(3):
+                dispatcher.dispatch(sender=None, mail_data={}, mail_object=None)
+            time.sleep(0.2)
+            # Reported while it is still running
+            stats = list(dispatcher.stats().values())[0]
+            self.assertEqual((stats['calls'], stats['timeouts'], stats['dropped']), (0, 1, 2))
+        self.assertTrue(any('running for more than' in line for line in logs.output))
+        release.set()
+        dispatcher.join(5)
+        stats = list(dispatcher.stats().values())[0]
+        self.assertEqual((stats['calls'], stats['timeouts']), (1, 1))
+
+
+class TestDeduplicatedAttachments(TransactionTestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.payload = json.loads(open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read())
+        recent_message_ids.clear()
+        patcher = mock.patch.object(inbound_mail_options, 'DEDUPLICATE_ATTACHMENTS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save_mail(self, message_id):
+        self.payload['MessageID'] = message_id
+        data = PostmarkJSONParser().parse(BytesIO(json.dumps(self.payload).encode()))
+        return process_inbound_mail(data, sender=None, send_signal=False)
+
+    def test_identical_attachments_share_a_file(self):
+        first_mail = self.save_mail('first')
+        second_mail = self.save_mail('second')
+        names = set(InboundMailAttachment.objects.values_list('content', flat=True))
+        self.assertEqual(len(names), 1)
+        attachment = first_mail.attachments.all()[0]
+        self.assertEqual(attachment.content.read(), b'This is attachment contents, base-64 encoded.')
+        storage = attachment.content.storage
+
+        first_mail.delete()
+        self.assertTrue(storage.exists(attachment.content.name))
+        second_mail.delete()
+        self.assertFalse(storage.exists(attachment.content.name))
+
+    def test_shared_file_deleted_before_commit_is_restored(self):
+        first_mail = self.save_mail('first')
+        name = first_mail.attachments.all()[0].content.name
+        storage = InboundMailAttachment._meta.get_field('content').storage
+        with transaction.atomic():
+            self.save_mail('second')
+            # The first mail is deleted concurrently, before the second commits
+            first_mail.delete()
+            storage.delete(name)
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(storage.open(name).read(), b'This is attachment contents, base-64 encoded.')
+
+    def test_spooled_shared_file_is_restored(self):
+        with mock.patch.object(inbound_mail_options, 'ATTACHMENT_SPOOL_THRESHOLD', 1):
+            self.test_shared_file_deleted_before_commit_is_restored()
+
+    def test_failed_restore_is_logged(self):
+        first_mail = self.save_mail('first')
+        name = first_mail.attachments.all()[0].content.name
+        storage = InboundMailAttachment._meta.get_field('content').storage
+        with self.assertLogs('postmark_inbound', level='ERROR'):
+            with mock.patch('postmark_inbound.serializers.save_attachment_file', side_effect=IOError):
+                with transaction.atomic():
+                    second_mail = self.save_mail('second')
+                    storage.delete(name)
+        self.assertTrue(InboundMail.objects.filter(pk=second_mail.pk).exists())
+
+
+@override_settings(ROOT_URLCONF='postmark_inbound.urls')
+class TestInboundMailSpool(TransactionTestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.example_json = open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        recent_message_ids.clear()
+        for name, value in (('SPOOL_INBOUND_MAIL', True), ('SPOOL_DIR', self.spool_dir)):
+            patcher = mock.patch.object(inbound_mail_options, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_webhook_spools_payload(self):
+        response = self.client.post('/inbound', self.example_json,
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(InboundMailSpool(self.spool_dir)), 1)
+        self.assertEqual(InboundMail.objects.count(), 0)
+
+        call_command('process_inbound_spool', workers=2, stdout=StringIO())
+        self.assertEqual(len(InboundMailSpool(self.spool_dir)), 0)
+        self.assertEqual(InboundMail.objects.count(), 1)
+
+    def test_invalid_payload_is_moved_to_failed(self):
+        spool = InboundMailSpool(self.spool_dir)
+        spool.append(b'{"Subject": "Missing fields"}')
+        with self.assertLogs('postmark_inbound', level='ERROR'):
+            call_command('process_inbound_spool', stdout=StringIO())
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(len(os.listdir(spool.failed_dir)), 1)
+
+    def test_failing_payload_is_retried_in_later_runs(self):
+        spool = InboundMailSpool(self.spool_dir)
+        spool.append(self.example_json.encode())
+        with mock.patch('postmark_inbound.management.commands.process_inbound_spool.process_inbound_mail',
+                        side_effect=DatabaseError()) as process:
+            for attempt in range(1, 3):
+                with self.assertLogs('postmark_inbound', level='ERROR'):
+                    call_command('process_inbound_spool', max_attempts=2, stdout=StringIO())
+                # Tried once per run
+                self.assertEqual(process.call_count, attempt)
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(os.listdir(spool.failed_dir)[0].split('.')[-2], '1')
+
+
+class TestImportInboundMail(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        payload = json.loads(open(os.path.join(BASE_DIR, 'example_0_attachments.json')).read())
+        self.import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.import_dir)
+        recent_message_ids.clear()
+        with open(os.path.join(self.import_dir, 'dump.jsonl'), 'w') as f:
+            f.write(json.dumps(payload) + '\n')
+            f.write('{"Subject": "Missing fields"}\n')
+            payload['MessageID'] = 'another-message-id'
+            f.write(json.dumps(payload) + '\n')
+        self.checkpoint = os.path.join(self.import_dir, 'checkpoint')
+
+    def import_mail(self):
+        call_command('import_inbound_mail', self.import_dir, processes=0, chunk_size=2,
+                     checkpoint=self.checkpoint, stdout=StringIO(), stderr=StringIO())
+
+    def test_import_skips_invalid_payloads(self):
+        self.import_mail()
+        self.assertEqual(InboundMail.objects.count(), 2)
+
+    def test_import_resumes_from_checkpoint(self):
+        self.import_mail()
+        self.import_mail()
+        self.assertEqual(InboundMail.objects.count(), 2)
+        with open(self.checkpoint) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+
+class TestInboundMailReadAPI(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        payload = json.loads(open(os.path.join(BASE_DIR, 'example_0_attachments.json')).read())
+        recent_message_ids.clear()
+        for i in range(5):
+            payload.update(MessageID='message-%d' % i, MailboxHash='tenant-%d' % (i % 2),
+                           Date='Fri, %d Aug 2014 16:45:32 -0400' % (1 + i // 2))
+            process_inbound_mail(PostmarkJSONParser().parse(BytesIO(json.dumps(payload).encode())),
+                                 sender=None)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_requires_admin_user(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/mail/').status_code, 403)
+
+    def test_pages_follow_date_and_id(self):
+        expected = list(InboundMail.objects.order_by('-date', '-id').values_list('message_id', flat=True))
+        message_ids = []
+        url = '/mail/?page_size=2'
+        while url:
+            # Session, user, mail and three prefetches, however deep the page
+            with self.assertNumQueries(6):
+                response = self.client.get(url)
+            message_ids += [mail['message_id'] for mail in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(message_ids, expected)
+
+        response = self.client.get('/mail/?ordering=date')
+        self.assertEqual([mail['message_id'] for mail in response.data['results']], expected[::-1])
+
+    def test_filters(self):
+        response = self.client.get('/mail/', {'mailbox_hash': 'tenant-1'})
+        self.assertEqual(len(response.data['results']), 2)
+        recipient = InboundMail.objects.first().to_full[0].email
+        response = self.client.get('/mail/', {'recipient': recipient, 'tag': 'no-such-tag'})
+        self.assertEqual(len(response.data['results']), 0)
+        response = self.client.get('/mail/', {'recipient': recipient})
+        self.assertEqual(len(response.data['results']), 5)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/mail/', {'cursor': 'nonsense'}).status_code, 404)
+
+    def test_retrieve(self):
+        inbound_mail = InboundMail.objects.first()
+        response = self.client.get('/mail/%d/' % inbound_mail.pk)
+        self.assertEqual(response.data['message_id'], inbound_mail.message_id)
+
+
+class TestExportInboundMail(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.payload = json.loads(open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read())
+        recent_message_ids.clear()
+        process_inbound_mail(PostmarkJSONParser().parse(BytesIO(json.dumps(self.payload).encode())),
+                             sender=None)
+
+    def test_b64encode_file_matches_b64encode(self):
+        content = os.urandom(1000)
+        self.assertEqual(''.join(b64encode_file(BytesIO(content), chunk_size=30)),
+                         b64encode(content).decode())
+
+    def test_export_round_trip(self):
+        export_path = os.path.join(tempfile.mkdtemp(), 'export.jsonl')
+        self.addCleanup(shutil.rmtree, os.path.dirname(export_path))
+        call_command('export_inbound_mail', output=export_path, batch_size=1)
+        with open(export_path) as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 1)
+
+        exported = json.loads(lines[0])
+        for key in ('From', 'Subject', 'MessageID', 'TextBody', 'ToFull', 'Headers'):
+            self.assertEqual(exported[key], self.payload[key])
+        self.assertEqual(parse(exported['Date']), parse(self.payload['Date']))
+        self.assertEqual([b64decode(a['Content']) for a in exported['Attachments']],
+                         [b64decode(a['Content']) for a in self.payload['Attachments']])
+
+        InboundMail.objects.all().delete()
+        recent_message_ids.clear()
+        call_command('import_inbound_mail', export_path, processes=0, stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(InboundMail.objects.get().attachments.count(), 2)
+
+    def test_export_endpoint_streams_jsonl(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get('/mail/export/', {'tag': self.payload['Tag']})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])['MessageID'], self.payload['MessageID'])
+        response = self.client.get('/mail/export/', {'tag': 'no-such-tag'})
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+
+class TestPartitioning(TestCase):
+    def test_partition_names(self):
+        month = add_months(datetime.date(2014, 11, 1), 2)
+        self.assertEqual(month, datetime.date(2015, 1, 1))
+        self.assertEqual(partition_name(month), 'postmark_inbound_inboundmail_p201501')
+        self.assertEqual(partition_month(partition_name(month)), month)
+        self.assertIsNone(partition_month('postmark_inbound_inboundmail_default'))
+
+    def test_convert_statements(self):
+        statements = convert_statements(connection, datetime.date(2014, 9, 1),
+                                        [('postmark_inbound_inboundmailheader', 'parent_mail_fk')])
+        self.assertTrue(statements[0].startswith('ALTER TABLE "postmark_inbound_inboundmailheader" DROP CONSTRAINT'))
+        self.assertEqual(statements[1], 'DROP INDEX IF EXISTS "postmark_inbound_unique_message_id"')
+        self.assertIn('PARTITION BY RANGE ("date")', statements[3])
+        self.assertIn('CREATE INDEX ON "postmark_inbound_inboundmail" ("mailbox_hash", "date", "id")', statements)
+        self.assertIn("FOR VALUES FROM (MINVALUE) TO ('2014-09-01 00:00:00+00')", statements[-2])
+
+    def test_create_partition_moves_rows_from_default(self):
+        statements = create_partition_statements(connection, datetime.date(2014, 12, 1))
+        self.assertIn('DELETE FROM "postmark_inbound_inboundmail_default"', statements[1])
+        self.assertIn("FOR VALUES FROM ('2014-12-01 00:00:00+00') TO ('2015-01-01 00:00:00+00')", statements[2])
+
+    @mock.patch('postmark_inbound.partitioning.get_detached_partitions',
+                return_value=['postmark_inbound_inboundmail_p201401'])
+    @mock.patch('postmark_inbound.partitioning.get_partitions', return_value=[
+        'postmark_inbound_inboundmail_default', 'postmark_inbound_inboundmail_legacy',
+        'postmark_inbound_inboundmail_p201402', 'postmark_inbound_inboundmail_p201403'])
+    def test_partitions_before(self, get_partitions, get_detached_partitions):
+        month = datetime.date(2014, 3, 1)
+        self.assertEqual(partitions_before(month), ['postmark_inbound_inboundmail_p201402'])
+        self.assertEqual(partitions_before(month, include_detached=True),
+                         ['postmark_inbound_inboundmail_p201401', 'postmark_inbound_inboundmail_p201402'])
+
+    def test_requires_postgresql(self):
+        with self.assertRaisesMessage(CommandError, 'PostgreSQL 11'):
+            call_command('partition_inbound_mail', stdout=StringIO())
+
+
+class TestPurgeInboundMail(TestCase):
+    def setUp(self):
+        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+        self.payload = json.loads(open(os.path.join(BASE_DIR, 'example_2_attachments.json')).read())
+        recent_message_ids.clear()
+
+    def save_mail(self, message_id, date):
+        self.payload['MessageID'] = message_id
+        self.payload['Date'] = date
+        data = PostmarkJSONParser().parse(BytesIO(json.dumps(self.payload).encode()))
+        return process_inbound_mail(data, sender=None, send_signal=False)
+
+    def test_purge_by_age(self):
+        old_mail = self.save_mail('old', 'Fri, 1 Aug 2014 16:45:32 -04:00')
+        new_mail = self.save_mail('new', timezone.now().strftime('%a, %d %b %Y %H:%M:%S +0000'))
+        old_files = [a.content.name for a in old_mail.attachments.all()]
+        storage = InboundMailAttachment._meta.get_field('content').storage
+
+        call_command('purge_inbound_mail', days=30, sleep=0, stdout=StringIO())
+        self.assertEqual(list(InboundMail.objects.all()), [new_mail])
+        self.assertEqual(InboundMailHeader.objects.filter(parent_mail_id=old_mail.pk).count(), 0)
+        self.assertEqual(InboundMailAttachment.objects.count(), 2)
+        self.assertFalse(any(storage.exists(name) for name in old_files))
+
+    def test_delete_related_rows_only(self):
+        mail = self.save_mail('old', 'Fri, 1 Aug 2014 16:45:32 -04:00')
+        delete_mail([mail.pk], related_only=True)
+        self.assertEqual(list(InboundMail.objects.all()), [mail])
+        self.assertEqual(InboundMailAttachment.objects.count(), 0)
+        self.assertEqual(InboundMailHeader.objects.count(), 0)
+
+    def test_purge_by_count(self):
+        self.save_mail('first', 'Fri, 1 Aug 2014 16:45:32 -04:00')
+        self.save_mail('second', 'Sat, 2 Aug 2014 16:45:32 -04:00')
+        third_mail = self.save_mail('third', 'Sun, 3 Aug 2014 16:45:32 -04:00')
+        call_command('purge_inbound_mail', max_count=1, batch_size=1, sleep=0, stdout=StringIO())
+        self.assertEqual(list(InboundMail.objects.all()), [third_mail])
+
+
+class TestBenchmark(TestCase):
+    def test_benchmark_times_each_stage(self):
+        receiver = mock.Mock()
+        inbound_mail_received.connect(receiver)
+        self.addCleanup(inbound_mail_received.disconnect, receiver)
+        with mock.patch.object(FileExtensionResolver, 'from_content', return_value='.pdf') as from_content:
+            results = run_benchmark(iterations=1, headers=5, recipients=2, attachments=2, attachment_size=1024)
+        self.assertEqual(InboundMail.objects.count(), 0)
+        # Project receivers don't run, and the unnamed attachment is sniffed
+        self.assertFalse(receiver.called)
+        self.assertTrue(from_content.called)
+        self.assertEqual(
+            set(results['stages']),
+            set(['parse', 'underscoreize', 'validate', 'decode_attachments',
+                 'resolve_extensions', 'create', 'signal']))
+        self.assertTrue(results['peak_memory_bytes'] > 0)
+
+        self.assertEqual(compare_results(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower['stages']['parse']['median'] *= 2
+        self.assertEqual([r[0] for r in compare_results(slower, results)], ['parse'])
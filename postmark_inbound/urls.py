@@ -1,8 +1,11 @@
 from django.conf.urls import url
 
-from .views import InboundMailWebhook
+from .views import InboundMailExportView, InboundMailListView, InboundMailRetrieveView, InboundMailWebhook
 
 
 urlpatterns = [
-    url(r'^inbound', InboundMailWebhook.as_view())
+    url(r'^inbound', InboundMailWebhook.as_view()),
+    url(r'^mail/$', InboundMailListView.as_view()),
+    url(r'^mail/export/$', InboundMailExportView.as_view()),
+    url(r'^mail/(?P<pk>\d+)/$', InboundMailRetrieveView.as_view()),
 ]
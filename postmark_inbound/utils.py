@@ -1,4 +1,322 @@
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+import threading
+import uuid
+import weakref
+from base64 import b64decode, b64encode
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from functools import wraps
+from mimetypes import guess_extension
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import transaction
+from django.utils.timezone import get_fixed_timezone
+from django.utils.module_loading import import_string
+from six import string_types, text_type
+
+import magic
+
+from .settings import inbound_mail_options as option
+
+logger = logging.getLogger(__name__)
+
+# Number of base64 characters decoded at a time (must be a multiple of 4)
+DECODE_CHUNK_SIZE = 256 * 1024
+# Number of bytes encoded at a time (must be a multiple of 3)
+ENCODE_CHUNK_SIZE = 192 * 1024
+
+MONTHS = dict((month, i + 1) for i, month in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')))
+
+# RFC 2822 dates as sent by Postmark, e.g. 'Fri, 1 Aug 2014 16:45:32 -04:00'
+rfc2822_date_re = re.compile(
+    r'^\s*(?:[a-z]{3},\s*)?(\d{1,2})\s+([a-z]{3})\s+(\d{4})\s+(\d{2}):(\d{2})(?::(\d{2}))?'
+    r'\s+([+-])(\d{2}):?(\d{2})\s*$', re.IGNORECASE)
+
+
+def parse_rfc2822_date(value):
+    """
+    Parse an RFC 2822 date with a numeric UTC offset into an aware datetime.
+    Returns None for anything else (e.g. named time zones or comments), which
+    is left to `dateutil`.
+    """
+    match = rfc2822_date_re.match(value)
+    if match is None:
+        return None
+    day, month, year, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    month = MONTHS.get(month.lower())
+    if month is None:
+        return None
+    offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+    try:
+        return datetime(int(year), month, int(day), int(hour), int(minute), int(second or 0),
+                        tzinfo=get_fixed_timezone(-offset if sign == '-' else offset))
+    except ValueError:
+        return None
+
+
+class FileExtensionResolver(object):
+    """
+    Pick a file extension for attachment content. In order of preference the
+    extension is taken from:
+
+        1. the content type declared by Postmark
+        2. the extension of the attachment's file name
+        3. libmagic, sniffing at most `sniff_bytes` of the content
+
+    A single libmagic handle is shared between calls.
+    """
+    sniff_bytes = 2048
+    generic_content_types = ('', 'application/octet-stream', 'binary/octet-stream')
+    file_ext_re = re.compile(r'^\.[A-Za-z0-9]{1,10}$')
+
+    def __init__(self):
+        self._magic = None
+        self._lock = threading.Lock()
+
+    def from_content_type(self, content_type):
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        if content_type in self.generic_content_types:
+            return None
+        return guess_extension(content_type, strict=True)
+
+    def from_name(self, name):
+        file_ext = os.path.splitext(name or '')[1]
+        if self.file_ext_re.match(file_ext):
+            return file_ext.lower()
+        return None
+
+    def from_content(self, head):
+        with self._lock:
+            if self._magic is None:
+                self._magic = magic.Magic(mime=True)
+            content_type = self._magic.from_buffer(head[:self.sniff_bytes])
+        if isinstance(content_type, bytes):
+            content_type = content_type.decode('UTF8')
+        return guess_extension(content_type, strict=True)
+
+    def resolve(self, head=b'', content_type=None, name=None):
+        return (self.from_content_type(content_type) or
+                self.from_name(name) or
+                self.from_content(head) or '')
+
+
+_extension_resolver = None
+
+
+def get_extension_resolver():
+    """
+    Return the shared instance of the `FILE_EXTENSION_RESOLVER` class.
+    """
+    global _extension_resolver
+    if _extension_resolver is None:
+        _extension_resolver = import_string(option.FILE_EXTENSION_RESOLVER)()
+    return _extension_resolver
+
+
+def generate_file_name(head, content_hash=None, content_type=None, name=None):
+    """
+    Generate a file name for attachment content, with an extension picked by
+    the `FILE_EXTENSION_RESOLVER`. The name is the content hash if one is
+    given, otherwise a random UUID.
+    """
+    file_ext = get_extension_resolver().resolve(head, content_type=content_type, name=name)
+    return ''.join([content_hash or uuid.uuid4().hex, file_ext])
+
+
+def content_hasher():
+    """
+    Return a hash object for content-addressed attachment storage, or None if
+    the `DEDUPLICATE_ATTACHMENTS` option is disabled.
+    """
+    if option.DEDUPLICATE_ATTACHMENTS:
+        return hashlib.sha256()
+    return None
+
+
+def b64decode_to_file(data, file, chunk_size=DECODE_CHUNK_SIZE, hasher=None):
+    """
+    Decode a base64 string into `file` a chunk at a time so the decoded content
+    is never held in memory as a whole. Each decoded chunk is also fed to
+    `hasher`, if given. Returns the first decoded chunk.
+    """
+    head = None
+    remainder = ''
+    for start in range(0, len(data), chunk_size):
+        # Whitespace is ignored by the decoder, so strip it to keep each chunk
+        # aligned to a 4 character boundary
+        chunk = remainder + ''.join(data[start:start + chunk_size].split())
+        boundary = len(chunk) - len(chunk) % 4
+        chunk, remainder = chunk[:boundary], chunk[boundary:]
+        decoded = b64decode(chunk)
+        if head is None:
+            head = decoded
+        if hasher is not None:
+            hasher.update(decoded)
+        file.write(decoded)
+    if remainder:
+        # Let the decoder raise on incomplete input
+        file.write(b64decode(remainder))
+    return head or b''
+
+
+def b64encode_file(file, chunk_size=ENCODE_CHUNK_SIZE):
+    """
+    Base64 encode `file` a chunk at a time, yielding the encoded chunks.
+    Concatenated, they are the same as encoding the whole file at once.
+    """
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        yield b64encode(chunk).decode('ascii')
+
+
+def spool_base64_file(data, content_type=None, name=None):
+    """
+    Decode a base64 string into a `TemporaryUploadedFile` on disk. When
+    attachments are deduplicated, the hash of the content is stored on the
+    file as `content_hash`.
+    """
+    spooled_file = TemporaryUploadedFile('attachment', content_type, 0, None)
+    hasher = content_hasher()
+    try:
+        head = b64decode_to_file(data, spooled_file, hasher=hasher)
+    except Exception:
+        spooled_file.close()
+        raise
+    spooled_file.size = spooled_file.tell()
+    spooled_file.seek(0)
+    spooled_file.content_hash = hasher.hexdigest() if hasher else None
+    spooled_file.name = generate_file_name(head, spooled_file.content_hash,
+                                           content_type=content_type, name=name)
+    return spooled_file
+
+
+def is_spoolable_attachment(data, threshold):
+    """
+    Check whether a (translated) JSON object is an attachment whose encoded
+    content exceeds `threshold` characters.
+    """
+    content = data.get('content')
+    return ('content_type' in data and isinstance(content, string_types) and
+            len(content) > threshold)
+
+
+class LRUCache(object):
+    """
+    A small thread-safe, least-recently-used cache.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_missing = object()
+
+
+class IPAllowList(object):
+    """
+    A set of IPv4/IPv6 addresses and CIDR ranges, compiled into sorted,
+    merged integer intervals so each lookup is a binary search. Results are
+    cached per address.
+
+        >>> '50.31.156.6' in IPAllowList(['50.31.156.0/24', '::1'])
+        True
+    """
+    def __init__(self, networks, cache_size=1024):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            network = ipaddress.ip_network(text_type(network), strict=False)
+            ranges[network.version].append(
+                (int(network.network_address), int(network.broadcast_address)))
+
+        self._starts = {}
+        self._ends = {}
+        for version, intervals in ranges.items():
+            merged = []
+            for start, end in sorted(intervals):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._starts[version] = [start for start, end in merged]
+            self._ends[version] = [end for start, end in merged]
+        self._cache = LRUCache(cache_size)
+
+    def __contains__(self, address):
+        allowed = self._cache.get(address)
+        if allowed is None:
+            allowed = self._lookup(address)
+            self._cache.set(address, allowed)
+        return allowed
+
+    def __bool__(self):
+        return any(self._starts.values())
+    __nonzero__ = __bool__
+
+    def _lookup(self, address):
+        try:
+            address = ipaddress.ip_address(text_type(address).strip())
+        except ValueError:
+            return False
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        value = int(address)
+        i = bisect_right(self._starts[address.version], value) - 1
+        return i >= 0 and value <= self._ends[address.version][i]
+
+
+def on_rollback(func, using=None):
+    """
+    Call `func` if the current transaction is rolled back (including a
+    savepoint it is in). Django only has commit hooks, so this relies on the
+    hook registered with `transaction.on_commit()` being discarded on rollback
+    instead of called.
+    """
+    state = {'committed': False}
+
+    def mark_committed():
+        state['committed'] = True
+
+    def finalize():
+        if not state['committed']:
+            try:
+                func()
+            except Exception:
+                logger.exception('Rollback handler %r raised an exception', func)
+
+    weakref.finalize(mark_committed, finalize).atexit = False
+    transaction.on_commit(mark_committed, using=using)
 
 
 class ChainableBase(object):
@@ -21,10 +339,20 @@ class InboundMailRelationMapper(ChainableBase):
     """
     Creates a model instance for each data item. Keyword arguments are
     appended to each item in the data.
+
+    In bulk mode (see `bulk()`), `create_for()` only builds the instances and
+    `bulk_create()` saves them with a single query per model.
     """
     def __init__(self, **kwargs):
         # Common attributes applicable to all models are passed as keyword argments (e.g. model instance for a shared foreign key)
         self.common_attributes = kwargs
+        self.bulk_mode = False
+        # Unsaved instances collected by `build_for()`, shared between chained copies
+        self.pending = OrderedDict()
+
+    @chain
+    def bulk(self):
+        self.bulk_mode = True
 
     @chain
     def data(self, data):
@@ -47,6 +375,10 @@ class InboundMailRelationMapper(ChainableBase):
 
     @chain
     def create_for(self, target_model):
+        if self.bulk_mode:
+            self.build_for(target_model)
+            return
+
         # Multiple relation
         if isinstance(self.data, list):
             relations = []
@@ -57,3 +389,24 @@ class InboundMailRelationMapper(ChainableBase):
         # Single relation
         elif isinstance(self.data, dict):
             return target_model.objects.create(**self.data)
+
+    @chain
+    def build_for(self, target_model):
+        instances = self.pending.setdefault(target_model, [])
+        if isinstance(self.data, list):
+            for data in self.data:
+                instances.append(target_model(**data))
+        elif isinstance(self.data, dict):
+            instances.append(target_model(**self.data))
+
+    def bulk_create(self, batch_size=None):
+        """
+        Save the instances collected by `build_for()` with a single
+        `bulk_create()` per model. Note that `bulk_create()` does not send
+        model signals.
+        """
+        created = OrderedDict()
+        while self.pending:
+            target_model, instances = self.pending.popitem(last=False)
+            created[target_model] = target_model.objects.bulk_create(instances, batch_size=batch_size)
+        return created
@@ -0,0 +1,220 @@
+"""
+Fast validation of inbound mail payloads, enabled with the `FAST_VALIDATION`
+option.
+
+Rather than validating through the tree of nested DRF serializers and their
+fields, payloads are checked against a schema compiled once from the models.
+Only payloads that would pass `InboundMailSerializer` are accepted, producing
+the same validated data. Anything else (including anything the fast path is
+unsure about, like non-string values) is validated by the serializer, so
+errors are reported exactly as before.
+"""
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import models
+from six import string_types
+
+from dateutil.parser import parse
+from rest_framework import serializers
+from rest_framework.fields import empty
+
+from .instrumentation import null_timer
+from .models import InboundMail, InboundMailAttachment, InboundMailDetail, InboundMailHeader
+from .serializers import (AutoDateTimeField, InboundMailSerializer, add_attachment_extension,
+                          decode_base64_file)
+from .utils import parse_rfc2822_date
+
+# Range accepted for integers without asking the database backend
+INTEGER_RANGE = (-2147483648, 2147483647)
+
+
+class Invalid(Exception):
+    """
+    Raised when the fast path can't accept a value.
+    """
+
+
+class FieldSpec(object):
+    """
+    Compiled validation rules for a single model field.
+    """
+    __slots__ = ('name', 'kind', 'required', 'allow_blank', 'max_length')
+
+    def __init__(self, model_field):
+        self.name = model_field.name
+        if isinstance(model_field, models.EmailField):
+            self.kind = 'email'
+        elif isinstance(model_field, models.IntegerField):
+            self.kind = 'integer'
+        else:
+            self.kind = 'char'
+        self.required = not (model_field.has_default() or model_field.blank or model_field.null)
+        self.allow_blank = model_field.blank
+        self.max_length = model_field.max_length
+
+    def validate(self, value):
+        if self.kind == 'integer':
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise Invalid(self.name)
+            if not INTEGER_RANGE[0] <= value <= INTEGER_RANGE[1]:
+                raise Invalid(self.name)
+            return value
+
+        if not isinstance(value, string_types):
+            raise Invalid(self.name)
+        value = value.strip()
+        if not value:
+            if not self.allow_blank:
+                raise Invalid(self.name)
+            return ''
+        if '\x00' in value or (self.max_length is not None and len(value) > self.max_length):
+            raise Invalid(self.name)
+        if self.kind == 'email':
+            try:
+                validate_email(value)
+            except ValidationError:
+                raise Invalid(self.name)
+        return value
+
+
+class RecordSpec(object):
+    """
+    Compiled validation rules for a nested record, e.g. a header.
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, model, field_names):
+        self.fields = tuple(FieldSpec(model._meta.get_field(name)) for name in field_names)
+
+    def validate(self, data):
+        if not isinstance(data, dict):
+            raise Invalid()
+        validated = OrderedDict()
+        for spec in self.fields:
+            value = data.get(spec.name, empty)
+            if value is empty:
+                if spec.required:
+                    raise Invalid(spec.name)
+                continue
+            validated[spec.name] = spec.validate(value)
+        return validated
+
+    def validate_list(self, data):
+        if not isinstance(data, list):
+            raise Invalid()
+        return [self.validate(item) for item in data]
+
+
+class InboundMailValidator(object):
+    """
+    Validate parsed inbound mail data (with underscored keys) against a
+    schema compiled from the models and `InboundMailSerializer.Meta.fields`.
+    """
+    def __init__(self):
+        self.date_field = AutoDateTimeField()
+        self.mail_fields = []
+        for name in InboundMailSerializer.Meta.fields:
+            if name == 'date':
+                self.mail_fields.append((name, 'date', None))
+            elif name in ('headers', 'attachments'):
+                self.mail_fields.append((name, 'optional_list', None))
+            elif name == 'from_full':
+                self.mail_fields.append((name, 'record', None))
+            elif name.endswith('_full'):
+                self.mail_fields.append((name, 'list', None))
+            else:
+                self.mail_fields.append((name, 'field', FieldSpec(InboundMail._meta.get_field(name))))
+
+        self.records = {
+            'headers': RecordSpec(InboundMailHeader, ('name', 'value')),
+            'attachments': RecordSpec(InboundMailAttachment,
+                                      ('name', 'content_type', 'content_id', 'content_length')),
+        }
+        detail = RecordSpec(InboundMailDetail, ('email', 'name', 'mailbox_hash'))
+        for name in ('from_full', 'to_full', 'cc_full', 'bcc_full'):
+            self.records[name] = detail
+
+    def validate_date(self, value):
+        if not isinstance(value, string_types):
+            raise Invalid('date')
+        parsed = parse_rfc2822_date(value)
+        if parsed is None:
+            try:
+                parsed = parse(value)
+            except (ValueError, OverflowError):
+                raise Invalid('date')
+        try:
+            return self.date_field.enforce_timezone(parsed)
+        except serializers.ValidationError:
+            raise Invalid('date')
+
+    def validate_attachment(self, data, timer):
+        validated = self.records['attachments'].validate(data)
+        content = data.get('content', empty)
+        if isinstance(content, string_types):
+            try:
+                with timer.stage('decode'):
+                    content = decode_base64_file(content, sniff_extension=False)
+            except Exception:
+                raise Invalid('content')
+        if not (getattr(content, 'name', None) and getattr(content, 'size', None)):
+            raise Invalid('content')
+
+        attrs = OrderedDict([('content', content)])
+        attrs.update(validated)
+        return add_attachment_extension(attrs)
+
+    def validate(self, data, timer=null_timer):
+        """
+        Return validated data for `data`, or None if it has to be validated
+        by `InboundMailSerializer`.
+        """
+        if not isinstance(data, dict):
+            return None
+
+        try:
+            validated = OrderedDict()
+            # Attachments are validated last, after the cheap checks
+            attachments = empty
+            for name, kind, spec in self.mail_fields:
+                value = data.get(name, empty)
+                if value is empty:
+                    if kind == 'optional_list' or (kind == 'field' and not spec.required):
+                        continue
+                    return None
+                if kind == 'field':
+                    validated[name] = spec.validate(value)
+                elif kind == 'date':
+                    validated[name] = self.validate_date(value)
+                elif kind == 'record':
+                    validated[name] = self.records[name].validate(value)
+                elif name == 'attachments':
+                    if not isinstance(value, list):
+                        return None
+                    attachments = value
+                    validated[name] = None
+                else:
+                    validated[name] = self.records[name].validate_list(value)
+
+            if attachments is not empty:
+                validated['attachments'] = [self.validate_attachment(item, timer) for item in attachments]
+        except Invalid:
+            return None
+        return validated
+
+
+inbound_mail_validator = InboundMailValidator()
+
+
+class FastInboundMailSerializer(InboundMailSerializer):
+    """
+    `InboundMailSerializer` trying `InboundMailValidator` before validating
+    through the nested serializers.
+    """
+    def run_validation(self, data=empty):
+        validated = inbound_mail_validator.validate(data, self.context.get('timer', null_timer))
+        if validated is not None:
+            return validated
+        return super(FastInboundMailSerializer, self).run_validation(data)
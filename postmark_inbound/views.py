@@ -1,45 +1,153 @@
-from rest_framework import permissions, status
+from django.db import connection
+from django.http import StreamingHttpResponse
+from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from .export import export_mail
+from .instrumentation import RequestTimer, null_timer
+from .models import InboundMail, InboundMailDetail
+from .pagination import KeysetPagination
 from .serializers import InboundMailSerializer
 from .parsers import PostmarkJSONParser
-from .signals import inbound_mail_received
+from .processing import process_inbound_mail
+from .signals import inbound_mail_timed
+from .spool import get_spool
 from .settings import inbound_mail_options as option
+from .utils import IPAllowList
 
 
 class PostmarkPermission(permissions.BasePermission):
     """
     Basic permission to whitelist IPs used by Postmark's inbound web hooks.
     """
-    postmark_inbound_ip = option.IP_WHITE_LIST
+    postmark_inbound_ip = IPAllowList(option.IP_WHITE_LIST)
+    trusted_proxies = IPAllowList(option.TRUSTED_PROXIES)
+
+    def get_client_ip(self, request):
+        remote_addr = request.META.get('REMOTE_ADDR')
+        proxy_depth = option.TRUSTED_PROXY_DEPTH
+        # Requests that don't come through a trusted proxy (if they are
+        # listed) are from the client itself, whatever headers it sent
+        if proxy_depth and (not self.trusted_proxies or
+                            (remote_addr is not None and remote_addr in self.trusted_proxies)):
+            # Each trusted proxy appends the address it received the request
+            # from, so only the rightmost entries can be trusted
+            forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR', '')
+            addresses = [address.strip() for address in forwarded_for.split(',') if address.strip()]
+            if len(addresses) < proxy_depth:
+                return None
+            return addresses[-proxy_depth]
+
+        if (option.TRUST_X_REAL_IP and request.META.get('HTTP_X_REAL_IP') and
+                remote_addr is not None and remote_addr in self.trusted_proxies):
+            return request.META['HTTP_X_REAL_IP']
+        return remote_addr
 
     def has_permission(self, request, view):
-        remote_addr = (request.META.get('HTTP_X_REAL_IP') or
-                       request.META.get('REMOTE_ADDR'))
-        return remote_addr in self.postmark_inbound_ip
+        remote_addr = self.get_client_ip(request)
+        return remote_addr is not None and remote_addr in self.postmark_inbound_ip
 
 
 class InboundMailWebhook(APIView):
     """
     API endpoint that allows inbound mail from Postmark to be received and
     saved to the database.
+
+    If the `SPOOL_INBOUND_MAIL` option is enabled the raw payload is only
+    written to the spool, to be processed later by the `process_inbound_spool`
+    management command.
+
+    With the `INSTRUMENTATION` option enabled, the duration of each stage is
+    returned in a `Server-Timing` header and sent with the
+    `inbound_mail_timed` signal.
     """
     serializer_class = InboundMailSerializer
     permission_classes = (PostmarkPermission,)
     parser_classes = (PostmarkJSONParser,)
+    timer = None
+    mail_object = None
 
     def post(self, request, format=None):
-        serializer = InboundMailSerializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-
-        mail_data = serializer.validated_data
-        mail_object = serializer.save() if option.SAVE_MAIL_TO_DB else None
-
-        # Send signal notifying that a new inbound mail has been received
-        inbound_mail_received.send_robust(sender=self.__class__,
-                                          mail_data=mail_data,
-                                          mail_object=mail_object)
+        if option.INSTRUMENTATION:
+            self.timer = RequestTimer()
+            self.timer.payload_bytes = int(request.META.get('CONTENT_LENGTH') or 0)
+            with self.timer.count_queries(connection):
+                self.receive(request)
+        else:
+            self.receive(request)
 
         success_msg = {'detail': 'Inbound mail received. Thanks Postmark!'}
         return Response(success_msg, status=status.HTTP_202_ACCEPTED)
+
+    def receive(self, request):
+        timer = self.timer or null_timer
+        if option.SPOOL_INBOUND_MAIL:
+            with timer.stage('spool'):
+                get_spool().append(request.body)
+        else:
+            with timer.stage('parse'):
+                data = request.data
+            self.mail_object = process_inbound_mail(data, sender=self.__class__, timer=self.timer)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(InboundMailWebhook, self).finalize_response(request, response, *args, **kwargs)
+        if self.timer is not None:
+            response['Server-Timing'] = self.timer.server_timing()
+            inbound_mail_timed.send_robust(sender=self.__class__,
+                                           timings=self.timer.as_dict(),
+                                           mail_object=self.mail_object)
+            if option.LOG_TIMINGS:
+                self.timer.log()
+        return response
+
+
+class InboundMailReadMixin(object):
+    """
+    Read access to stored inbound mail for admin users.
+    """
+    serializer_class = InboundMailSerializer
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get_queryset(self):
+        return InboundMail.objects.with_bodies().with_details()
+
+
+class InboundMailListView(InboundMailReadMixin, generics.ListAPIView):
+    """
+    List inbound mail, newest first, paginated by `(date, id)` (see
+    `KeysetPagination`). Filter with the `mailbox_hash`, `tag`, `from_email`
+    and `recipient` (a To, Cc or Bcc address) query parameters.
+    """
+    pagination_class = KeysetPagination
+    filter_fields = ('mailbox_hash', 'tag', 'from_email')
+
+    def get_queryset(self):
+        queryset = super(InboundMailListView, self).get_queryset()
+        params = self.request.query_params
+        for field in self.filter_fields:
+            if field in params:
+                queryset = queryset.filter(**{field: params[field]})
+        if 'recipient' in params:
+            recipients = InboundMailDetail.objects.filter(
+                email=params['recipient'], address_type__in=('TO', 'CC', 'BCC'))
+            queryset = queryset.filter(pk__in=recipients.values('parent_mail'))
+        return queryset
+
+
+class InboundMailRetrieveView(InboundMailReadMixin, generics.RetrieveAPIView):
+    pass
+
+
+class InboundMailExportView(InboundMailListView):
+    """
+    Stream mail as JSON lines in Postmark's payload shape, with attachments.
+    Takes the same filters as `InboundMailListView`.
+    """
+    pagination_class = None
+
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(export_mail(self.get_queryset()),
+                                         content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="inbound-mail.jsonl"'
+        return response
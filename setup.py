@@ -15,7 +15,7 @@ install_requires = open('requirements.txt').read().splitlines()
 setup(
     name='django-postmark-inbound',
     version=app.__version__,
-    packages=['postmark_inbound'],
+    packages=['postmark_inbound', 'postmark_inbound.migrations', 'postmark_inbound.management', 'postmark_inbound.management.commands'],
     include_package_data=True,
     license='BSD License',  # example license
     description='A simple Django app to conduct Web-based polls.',